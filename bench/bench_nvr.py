@@ -0,0 +1,314 @@
+#!/usr/bin/env python3
+
+"""
+Latency and throughput benchmarks for nvr against headless nvim processes.
+
+    $ python3 bench/bench_nvr.py -o results.json
+    $ python3 bench/bench_nvr.py -b results.json
+
+All nvim processes are started in parallel and nvr attaches as soon as they
+accept connections. Every case runs several times. The results
+contain percentiles of the wall time in milliseconds and the number of RPCs
+nvr issued, and are written as JSON. Given a baseline, cases whose median
+got slower than the tolerance are reported and the exit code is 1.
+"""
+
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import pynvim
+import nvr
+from nvr.nvr import Nvr, percentile
+from nvr.rpc import Client
+
+# Attach in a fresh interpreter and evaluate an expression.
+COLD_ATTACH = {
+    'pynvim': 'import sys, pynvim; pynvim.attach("socket", path=sys.argv[1]).eval("1")',
+    'builtin': 'import sys; from nvr.rpc import Client; Client.connect(sys.argv[1]).eval("1")',
+}
+
+
+class RpcCounter():
+    """
+    Count the RPCs issued through pynvim and the built-in client while
+    enabled.
+    """
+    def __init__(self):
+        self.count = 0
+        self.enabled = False
+        for cls in [pynvim.api.Nvim, Client]:
+            self.patch(cls)
+
+    def patch(self, cls):
+        request = cls.request
+        def counting_request(client, name, *args, **kwargs):
+            if self.enabled:
+                self.count += 1
+            return request(client, name, *args, **kwargs)
+        cls.request = counting_request
+
+    @contextlib.contextmanager
+    def counting(self):
+        self.count = 0
+        self.enabled = True
+        try:
+            yield
+        finally:
+            self.enabled = False
+
+
+class Server():
+    def __init__(self, tmpdir, name):
+        self.address = os.path.join(tmpdir, f'{name}.sock')
+        self.process = subprocess.Popen(
+                ['nvim', '--clean', '-n', '--headless', '--listen', self.address],
+                cwd=tmpdir, stdin=subprocess.DEVNULL)
+        self.control = None
+
+    def wait(self, timeout=10):
+        client = Nvr(self.address)
+        if not client.wait_for_server(timeout):
+            raise RuntimeError(f'nvim at {self.address} did not start')
+        self.control = client.server
+
+    def reset(self):
+        self.control.command('silent! %bwipeout! | silent! only | silent! tabonly')
+
+    def stop(self):
+        if self.control:
+            self.control.close()
+        self.process.terminate()
+        self.process.wait()
+
+
+def summarize(samples, rpcs=None):
+    ms = [s * 1000 for s in samples]
+    result = {
+        'runs': len(ms),
+        'min': min(ms),
+        'p50': percentile(ms, 50),
+        'p90': percentile(ms, 90),
+        'p99': percentile(ms, 99),
+        'max': max(ms),
+    }
+    if rpcs is not None:
+        result['rpcs'] = rpcs
+    return result
+
+
+class Bench():
+    def __init__(self, args):
+        self.args = args
+        self.tmpdir = tempfile.mkdtemp(prefix='nvr-bench-')
+        self.counter = RpcCounter()
+        self.results = {}
+        self.env = dict(os.environ)
+        # Neither use a running broker nor touch the user's registry.
+        self.env['NVR_BROKER'] = os.path.join(self.tmpdir, 'no-broker')
+        self.env['XDG_CACHE_HOME'] = os.path.join(self.tmpdir, 'cache')
+        self.env['PYTHONPATH'] = os.pathsep.join(filter(None, [ROOT, self.env.get('PYTHONPATH')]))
+        os.environ['XDG_CACHE_HOME'] = self.env['XDG_CACHE_HOME']
+
+    def path(self, name):
+        return os.path.join(self.tmpdir, name)
+
+    def nvr_main(self, server, argv, stdin=b''):
+        env = dict(self.env, NVIM_LISTEN_ADDRESS=server.address)
+        old_stdin = sys.stdin
+        sys.stdin = io.TextIOWrapper(io.BytesIO(stdin))
+        try:
+            with contextlib.redirect_stdout(io.StringIO()):
+                nvr.main(['nvr', '-s', '--nostart'] + argv, env)
+        finally:
+            sys.stdin = old_stdin
+
+    def run_nvr(self, server, argv, **kwargs):
+        env = dict(self.env, NVIM_LISTEN_ADDRESS=server.address) if server else self.env
+        cmd = [sys.executable, '-c', 'import sys, nvr; nvr.main(sys.argv)', '-s', '--nostart'] + argv
+        return subprocess.run(cmd, env=env, stdout=subprocess.DEVNULL, check=True, **kwargs)
+
+    def measure(self, name, fn, repeat, setup=None, count=True):
+        if self.args.cases and not any(c in name for c in self.args.cases):
+            return
+        samples = []
+        rpcs = None
+        for _ in range(repeat):
+            if setup:
+                setup()
+            if count:
+                with self.counter.counting():
+                    start = time.perf_counter()
+                    fn()
+                    samples.append(time.perf_counter() - start)
+                rpcs = self.counter.count
+            else:
+                start = time.perf_counter()
+                fn()
+                samples.append(time.perf_counter() - start)
+        self.results[name] = summarize(samples, rpcs)
+        print(f'{name:<24} ' + ' '.join(f'{k}={v:.2f}' if type(v) is float else f'{k}={v}'
+                                         for k, v in self.results[name].items()), file=sys.stderr)
+
+    def make_files(self, n):
+        directory = self.path(f'files{n}')
+        os.makedirs(directory, exist_ok=True)
+        paths = []
+        for i in range(n):
+            path = os.path.join(directory, f'file{i}')
+            with open(path, 'w') as f:
+                f.write(f'line {i}\n')
+            paths.append(path)
+        return paths
+
+    def run(self):
+        repeat = self.args.repeat
+        server, wait_server = Server(self.tmpdir, 'main'), Server(self.tmpdir, 'wait')
+        many = [Server(self.tmpdir, f'many{i}') for i in range(self.args.servers)]
+
+        try:
+            for s in [server, wait_server] + many:
+                s.wait()
+
+            self.measure('cold_import', lambda: subprocess.run(
+                    [sys.executable, '-c', 'import nvr'], env=self.env, check=True), repeat, count=False)
+            for name, code in COLD_ATTACH.items():
+                self.measure(f'cold_attach_{name}', lambda: subprocess.run(
+                        [sys.executable, '-c', code, server.address], env=self.env, check=True),
+                        repeat, count=False)
+            self.measure('cold_remote_expr', lambda: self.run_nvr(
+                    server, ['--remote-expr', '1']), repeat, count=False)
+
+            def attach():
+                client = Nvr(server.address)
+                client.attach()
+                client.server.close()
+            self.measure('attach', attach, repeat)
+
+            for n in [1, 100, 5000]:
+                paths = self.make_files(n)
+                self.measure(f'open_{n}', lambda: self.nvr_main(server, paths),
+                             max(1, repeat // (10 if n > 100 else 1)), setup=server.reset)
+
+            commands = ['-cc', 'let a = 1', '-cc', 'let b = 1', '-c', 'let c = 1', '-c', 'let d = 1']
+            self.measure('commands', lambda: self.nvr_main(server, commands + paths[:1]), repeat)
+            self.measure('commands_pipeline', lambda: self.nvr_main(
+                    server, ['--pipeline'] + commands + paths[:1]), repeat)
+
+            paths = self.make_files(5000)
+            self.measure('add_5000', lambda: self.nvr_main(server, ['--remote-add'] + paths),
+                         max(1, repeat // 10), setup=server.reset)
+
+            stdin = b''.join(b'line %d of a very large input\n' % i for i in range(self.args.lines))
+            self.measure('stdin', lambda: self.nvr_main(server, ['-'], stdin),
+                         max(1, repeat // 5), setup=server.reset)
+
+            errorfile = self.path('errors')
+            with open(errorfile, 'w') as f:
+                for i in range(self.args.lines):
+                    f.write(f'file{i % 100}.c:{i}:1: error: something went wrong\n')
+            self.measure('quickfix', lambda: self.nvr_main(server, ['-q', errorfile]),
+                         max(1, repeat // 5), setup=server.reset)
+
+            self.measure('remote_expr_list', lambda: self.nvr_main(
+                    server, ['--remote-expr', f'range({self.args.lines})']), repeat)
+
+            self.measure('serverlist', lambda: self.run_nvr(None, ['--serverlist']),
+                         repeat, count=False)
+
+            wait_file = self.path('wait')
+            def remote_wait():
+                proc = subprocess.Popen(
+                        [sys.executable, '-c', 'import sys, nvr; nvr.main(sys.argv)',
+                         '-s', '--nostart', '--remote-wait', wait_file],
+                        env=dict(self.env, NVIM_LISTEN_ADDRESS=wait_server.address))
+                while not wait_server.control.eval(f'len(getbufvar("{wait_file}", "nvr", []))'):
+                    time.sleep(0.001)
+                wait_server.control.command(f'bdelete! {wait_file}')
+                proc.wait()
+            self.measure('remote_wait', remote_wait, repeat, count=False)
+        finally:
+            for s in [server, wait_server] + many:
+                s.stop()
+            shutil.rmtree(self.tmpdir, ignore_errors=True)
+
+        return {
+            'meta': {
+                'time': time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+                'python': platform.python_version(),
+                'platform': platform.platform(),
+                'nvim': subprocess.run(['nvim', '--version'], stdout=subprocess.PIPE,
+                                       universal_newlines=True).stdout.splitlines()[0],
+                'repeat': repeat,
+                'lines': self.args.lines,
+                'servers': self.args.servers,
+            },
+            'results': self.results,
+        }
+
+
+def compare(results, baseline, tolerance):
+    """
+    Print the change of every median against the baseline and return the
+    names of the cases that got slower than the tolerance.
+    """
+    regressions = []
+    for name, result in results['results'].items():
+        old = baseline['results'].get(name)
+        if not old:
+            continue
+        ratio = result['p50'] / old['p50'] if old['p50'] else 1
+        rpcs = ''
+        if 'rpcs' in result and 'rpcs' in old and result['rpcs'] != old['rpcs']:
+            rpcs = f' (rpcs: {old["rpcs"]} -> {result["rpcs"]})'
+        print(f'{name:<24} p50 {old["p50"]:9.2f} -> {result["p50"]:9.2f} ms  x{ratio:.2f}{rpcs}')
+        if ratio > 1 + tolerance:
+            regressions.append(name)
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark nvr against headless nvim processes.')
+    parser.add_argument('-o', '--output', metavar='<file>', help='Write the results as JSON to this file.')
+    parser.add_argument('-b', '--baseline', metavar='<file>', help='Compare the results against this file.')
+    parser.add_argument('-t', '--tolerance', type=float, default=0.2,
+                        help='Allowed slowdown of the median compared to the baseline. Default: 0.2.')
+    parser.add_argument('-r', '--repeat', type=int, default=10, help='Runs per case. Default: 10.')
+    parser.add_argument('-l', '--lines', type=int, default=200000,
+                        help='Lines of stdin, errorfile and list results. Default: 200000.')
+    parser.add_argument('-s', '--servers', type=int, default=20,
+                        help='Additional nvim processes for --serverlist. Default: 20.')
+    parser.add_argument('cases', nargs='*', help='Only run cases whose name contains one of these.')
+    args = parser.parse_args()
+
+    results = Bench(args).run()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    else:
+        json.dump(results, sys.stdout, indent=2)
+        print()
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.tolerance)
+        if regressions:
+            print(f'Slower than the baseline: {", ".join(regressions)}', file=sys.stderr)
+            sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -19,10 +19,29 @@ _nvr_opts_completions()
         -q
         -s
         -t
+        --chunk-size
+        --follow
+        --max-lines
+        --large-size
+        --large
         --nostart
+        --trace
+        --pool
+        --pipeline
+        --batch
+        --stats
+        --daemon
+        --complete
         --version
         --serverlist
+        --ping
+        --count
         --servername
+        --target
+        --all
+        --timeout
+        --connect-timeout
+        --reclaim
         --remote
         --remote-wait
         --remote-silent
@@ -31,15 +50,37 @@ _nvr_opts_completions()
         --remote-tab-wait
         --remote-tab-silent
         --remote-tab-wait-silent
+        --remote-add
         --remote-send
         --remote-expr
+        --remote-read
+        --output
+        --paged
     )
     case "${prev}" in
-        --servername)
-            srvlist=$(nvr --serverlist)
+        --servername|--ping)
+            srvlist=$(nvr --complete servers)
             COMPREPLY=( $(compgen -W "${srvlist}" -- "$cur") )
             return 0
             ;;
+        --remote-read)
+            # Complete the buffers of the server given by --servername.
+            local addr=() i
+            for ((i = 1; i < COMP_CWORD - 1; i++)); do
+                [[ ${COMP_WORDS[i]} == --servername ]] && addr=( "${COMP_WORDS[i+1]}" )
+            done
+            local IFS=$'\n'
+            COMPREPLY=( $(compgen -W "$(nvr --complete buffers "${addr[@]}")" -- "$cur") )
+            return 0
+            ;;
+        --target)
+            COMPREPLY=( $(compgen -W "default auto" -- "$cur") )
+            return 0
+            ;;
+        --output)
+            COMPREPLY=( $(compgen -W "json ndjson raw" -- "$cur") )
+            return 0
+            ;;
         -[oOpq])
             # These options require at least one argument.
             COMPREPLY=( $(compgen -A file -- "$cur") )
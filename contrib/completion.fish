@@ -9,9 +9,20 @@ complete --command=nvr --long-option=remote-tab --description='Like --remote, bu
 complete --command=nvr --long-option=remote-tab-wait --description='Like --remote-wait, but use :tabedit'
 complete --command=nvr --long-option=remote-tab-silent --description='Like --remote-silent, but use :tabedit'
 complete --command=nvr --long-option=remote-tab-wait-silent --description='Like --remote-wait-silent, but use :tabedit'
+complete --command=nvr --long-option=remote-add --description='Add files to the buffer list without loading them and only open the first one'
 complete --command=nvr --long-option=remote-send --no-files --description='Send key presses'
 complete --command=nvr --long-option=remote-expr --no-files --description='Evaluate expression and print result in shell'
-complete --command=nvr --long-option=servername --no-files --arguments='(nvr --serverlist)' --description='Set the address to be used. This overrides the default "/tmp/nvimsocket" and $NVIM_LISTEN_ADDRESS'
+complete --command=nvr --long-option=remote-read --no-files --arguments='(nvr --complete buffers)' --description='Print the lines of a buffer'
+complete --command=nvr --long-option=output --no-files --arguments='json ndjson raw' --description='Print the result of --remote-expr as JSON, as JSON with one list item per line, or one list item per line'
+complete --command=nvr --long-option=paged --description='Fetch a list result of --remote-expr in pieces of --chunk-size items'
+complete --command=nvr --long-option=servername --no-files --arguments='(nvr --complete servers)' --description='Set the address to be used. This overrides the default "/tmp/nvimsocket" and $NVIM_LISTEN_ADDRESS'
+complete --command=nvr --long-option=all --description='Send -cc, -c, -l, --remote-send and --remote-expr to all nvim processes'
+complete --command=nvr --long-option=timeout --no-files --description='Give up on a server that does not respond in time'
+complete --command=nvr --long-option=connect-timeout --no-files --description='Give up if connecting to the server takes longer'
+complete --command=nvr --long-option=reclaim --description='Replace a Unix domain socket that nobody listens on with a new nvim process'
+complete --command=nvr --long-option=target --no-files --arguments='default auto' --description='How to choose the server if --servername is not given'
+complete --command=nvr --long-option=ping --no-files --arguments='(nvr --complete servers)' --description='Measure the round-trip time to servers'
+complete --command=nvr --long-option=count --no-files --description='Number of requests per server for --ping'
 complete --command=nvr --long-option=serverlist --description='Print the TCPv4 and Unix domain socket addresses of all nvim processes'
 complete --command=nvr --short-option=h --long-option=help --description='show help message and exit'
 complete --command=nvr --short-option=c --no-files --description='Execute a command after every other option'
@@ -23,6 +34,18 @@ complete --command=nvr --short-option=p --description='Open files via ":tabedit"
 complete --command=nvr --short-option=q --description='Read errorfile into quickfix list and display first error'
 complete --command=nvr --short-option=s --description='Silence "no server found" message'
 complete --command=nvr --short-option=t --no-files --description='Jump to file and position of given tag'
+complete --command=nvr --long-option=chunk-size --no-files --description='Maximum number of lines transferred per request, e.g. when reading from stdin'
+complete --command=nvr --long-option=follow --description='When reading from stdin, append to the buffer as data arrives until EOF'
+complete --command=nvr --long-option=max-lines --no-files --description='With --follow, keep at most that many lines'
+complete --command=nvr --long-option=large-size --no-files --description='Open files of at least that many MiB in large-file mode'
+complete --command=nvr --long-option=large --description='Open all files in large-file mode'
 complete --command=nvr --long-option=nostart --description='If no process is found, do not start a new one'
+complete --command=nvr --long-option=trace --description='Append the duration of every phase and RPC as JSON lines to a file or stderr'
+complete --command=nvr --long-option=pool --no-files --description='Edit the given files with several headless nvim processes in parallel'
+complete --command=nvr --long-option=pipeline --description='Send -cc, -c, -l, --remote-send and opening files in one request'
+complete --command=nvr --long-option=batch --description='Run one nvr command line per line of a file over a single connection'
+complete --command=nvr --long-option=stats --no-files --description='Print per-operation percentiles of the calls recorded via $NVR_STATS'
+complete --command=nvr --long-option=daemon --description='Run a broker that keeps connections to nvim processes open and handles subsequent nvr calls'
+complete --command=nvr --long-option=complete --no-files --arguments='servers buffers' --description='Print completions for shell completion scripts'
 complete --command=nvr --long-option=version --description='Show the nvr version'
 complete --command=nvr --old-option=cc --description='Execute a command before every other option'
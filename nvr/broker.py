@@ -0,0 +1,189 @@
+"""
+A long-lived process that keeps connections to nvim processes open and handles
+nvr calls on their behalf. That way a call doesn't have to pay for importing
+pynvim and attaching to nvim every time.
+
+Start it via `nvr --daemon`. The broker greets every connection. Only then
+the nvr client forwards its arguments, environment and working directory
+over a Unix domain socket and prints whatever the broker replies. Calls that read from stdin, wait for buffers or
+need to start a new nvim process are handed back to the client, as are
+calls that write a lot to stdout, like --remote-read.
+"""
+
+import contextlib
+import io
+import json
+import os
+import signal
+import socket
+import sys
+import textwrap
+import traceback
+
+from nvr import nvr as core
+
+# Seconds a client may take to send its request after the greeting.
+REQUEST_TIMEOUT = 1
+
+
+class Broker():
+    def __init__(self, path, silent=False):
+        self.path = path
+        self.silent = silent
+        self.servers = {}
+
+    def server_for(self, address, timeout):
+        server = self.servers.pop(address, None)
+        if server:
+            try:
+                # A cheap request that nvim answers even when it's busy.
+                server.expect_response(timeout)
+                server.request('nvim_get_mode')
+            except Exception:
+                with contextlib.suppress(Exception):
+                    server.close()
+                server = None
+        if not server:
+            nvr = core.Nvr(address)
+            nvr.attach()
+            server = nvr.server
+        if server:
+            # Like the client, give up if nvim doesn't answer the first
+            # request of the call, so that a hung nvim can't block the broker.
+            server.expect_response(timeout)
+            self.servers[address] = server
+        return server
+
+    def run(self, argv, env, cwd):
+        fallback = {'fallback': True}
+
+        try:
+            with contextlib.redirect_stdout(io.StringIO()), contextlib.redirect_stderr(io.StringIO()):
+                options, arguments = core.parse_args(argv)
+        except SystemExit:
+            # Let the client report invalid arguments.
+            return fallback
+
+        if (options.daemon
+                or options.version
+                or options.serverlist
+                or options.ping is not None
+                or options.pool
+                or options.stats
+                or options.complete
+                or options.target == 'auto'
+                or core.broadcasts(options)
+                or options.remote_read
+                or options.paged
+                or core.reads_stdin(options, arguments)
+                or core.waits_for_buffers(options)):
+            return fallback
+
+        address = core.resolve_address(options, env)
+        server = self.server_for(address, options.timeout or 5)
+        if not server:
+            return fallback
+
+        nvr = core.Nvr(address, options.s)
+        nvr.server = server
+
+        stdout, stderr = io.StringIO(), io.StringIO()
+        exitcode = 0
+        pwd = os.environ.get('PWD')
+        try:
+            os.chdir(cwd)
+            os.environ['PWD'] = env.get('PWD', cwd)
+            with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+                core.proceed_after_attach(nvr, options, arguments)
+        except TimeoutError as e:
+            print(f'[!] {e} Is nvim busy? Use --timeout to wait longer.', file=stderr)
+            exitcode = 1
+            self.servers.pop(address, None)
+            with contextlib.suppress(Exception):
+                server.close()
+        except SystemExit as e:
+            if e.code is None or type(e.code) is int:
+                exitcode = e.code or 0
+            else:
+                print(e.code, file=stderr)
+                exitcode = 1
+        except Exception:
+            traceback.print_exc(file=stderr)
+            exitcode = 1
+            # The connection might be broken. Check it on the next call.
+        finally:
+            if pwd is None:
+                os.environ.pop('PWD', None)
+            else:
+                os.environ['PWD'] = pwd
+
+        return {
+            'fallback': False,
+            'stdout': stdout.getvalue(),
+            'stderr': stderr.getvalue(),
+            'exitcode': exitcode,
+        }
+
+    def handle(self, conn):
+        # Don't let an idle client block the callers that wait behind it.
+        conn.settimeout(REQUEST_TIMEOUT)
+        with conn.makefile('rwb') as f:
+            try:
+                f.write(b'{"ready": true}\n')
+                f.flush()
+                request = json.loads(f.readline())
+            except (OSError, ValueError):
+                return
+            conn.settimeout(None)
+            reply = self.run(request['argv'], request['env'], request['cwd'])
+            with contextlib.suppress(OSError):
+                f.write(json.dumps(reply).encode() + b'\n')
+                f.flush()
+
+    def listen(self):
+        if os.path.exists(self.path):
+            with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+                try:
+                    probe.connect(self.path)
+                except ConnectionRefusedError:
+                    # Left behind by a broker that didn't exit cleanly.
+                    os.unlink(self.path)
+                else:
+                    print(f'[!] A broker is already listening on {self.path}.', file=sys.stderr)
+                    sys.exit(1)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        # Only the current user may talk to the broker.
+        umask = os.umask(0o077)
+        try:
+            listener.bind(self.path)
+        finally:
+            os.umask(umask)
+        listener.listen(16)
+        return listener
+
+    def serve(self):
+        listener = self.listen()
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+        if not self.silent:
+            print(textwrap.dedent(f'''\
+                [*] Listening on {self.path}
+
+                    Subsequent nvr calls are handled by this process now.
+                    Set $NVR_BROKER to use another address.
+            '''))
+
+        try:
+            while True:
+                conn, _ = listener.accept()
+                with conn:
+                    self.handle(conn)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            listener.close()
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.path)
+            for server in self.servers.values():
+                with contextlib.suppress(Exception):
+                    server.close()
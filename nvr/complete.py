@@ -0,0 +1,97 @@
+"""
+The backend of the shell completion scripts: `nvr --complete <context>`.
+
+Completions have to appear without noticeable delay, so they are served from
+the cache directory and pynvim is never imported in the foreground. A cache
+that is older than its TTL is still used, but gets refreshed in a background
+process for the next completion. Only a missing cache is filled right away.
+
+Contexts:
+
+    servers          The addresses of all nvim processes.
+    buffers [addr]   The names of the listed buffers of a server.
+"""
+
+import os
+import sys
+import time
+
+from nvr import nvr as core
+from nvr import registry
+
+# Rescan all processes for servers if the last scan is older than that.
+SERVERS_TTL = 10
+
+# Fetch the buffers of a server again if the snapshot is older than that.
+BUFFERS_TTL = 5
+
+
+def in_background(fn):
+    """
+    Run fn in a child process. Its output goes to /dev/null, so that a shell
+    reading the output of the completion doesn't wait for the child.
+    """
+    sys.stdout.flush()
+    if os.fork() == 0:
+        try:
+            devnull = os.open(os.devnull, os.O_RDWR)
+            for fd in range(3):
+                os.dup2(devnull, fd)
+            fn()
+        finally:
+            os._exit(0)
+
+
+def scan(env):
+    found, _ = core.find_addresses()
+    return registry.update_from_scan(found, env)
+
+
+def servers(env):
+    scanned = registry.scanned_at(env)
+    if scanned is None:
+        return sorted(scan(env))
+    if time.time() - scanned > SERVERS_TTL:
+        in_background(lambda: scan(env))
+    return sorted(registry.load(env))
+
+
+def snapshot_path(address, env):
+    name = address.replace('%', '%25').replace('/', '%2F')
+    return os.path.join(registry.cache_dir(env), 'buffers', f'{name}.json')
+
+
+def fetch_buffers(address, env):
+    nvr = core.Nvr(address)
+    nvr.attach()
+    if not nvr.server:
+        return []
+    try:
+        names = nvr.server.eval('map(getbufinfo({"buflisted": 1}), "v:val.name")')
+    finally:
+        nvr.server.close()
+    names = [name for name in names if name]
+    registry.save_json(snapshot_path(address, env), {'time': time.time(), 'buffers': names})
+    return names
+
+
+def buffers(address, env):
+    snapshot = registry.load_json(snapshot_path(address, env))
+    if snapshot is None:
+        return fetch_buffers(address, env)
+    if time.time() - snapshot['time'] > BUFFERS_TTL:
+        in_background(lambda: fetch_buffers(address, env))
+    return snapshot['buffers']
+
+
+def complete(args, env=os.environ):
+    context = args[0] if args else None
+    if context == 'servers':
+        candidates = servers(env)
+    elif context == 'buffers':
+        candidates = buffers(args[1] if len(args) > 1 else core.default_address(env), env)
+    else:
+        print(f'[!] Unknown completion context: {context}. Use "servers" or "buffers".', file=sys.stderr)
+        sys.exit(1)
+    for candidate in candidates:
+        print(candidate)
@@ -22,46 +22,508 @@ OUT OF OR IN CONNECTION WITH THE SOFTWARE OR THE USE OR OTHER DEALINGS IN
 THE SOFTWARE.
 """
 
-import argparse
-import multiprocessing
+# Only modules that are needed by every call are imported here. The rest is
+# imported where it's used, to keep the startup time low.
 import os
 import re
+import signal
 import sys
 import textwrap
 import time
-import traceback
 
-import psutil
-import pynvim
+# With --follow, send what arrived on stdin at least that often, in seconds.
+FOLLOW_INTERVAL = 0.05
+
+# Files that nvim reads via autocmds, e.g. the gzip, zip and tar plugins, are
+# never opened in large-file mode.
+DECODED_SUFFIXES = ('.gz', '.bz2', '.Z', '.lzma', '.xz', '.lz', '.zst', '.br',
+                    '.zip', '.jar', '.war', '.apk', '.docx', '.xlsx', '.pptx',
+                    '.tar', '.tgz', '.tbz', '.txz')
+
+# Seconds to wait for the broker to accept a connection.
+BROKER_CONNECT_TIMEOUT = 1
+
+
+# Keeps track of the buffers nvr clients wait for. It's installed once per
+# nvim process as package.loaded.nvr and reinstalled when VERSION changes.
+# Prepend it to any chunk that uses M.
+#
+# M.buffers maps buffer numbers to {[channel] = count}. Each buffer gets a
+# single BufDelete autocmd that sends "BufDelete" to every waiting channel,
+# once per registration. A single VimLeave autocmd sends "Exit" to every
+# waiting channel. Entries of closed channels are pruned on registration.
+LUA_WAIT_MODULE = r'''
+local VERSION = 1
+local M = package.loaded.nvr
+if not M or M.version ~= VERSION then
+  local old = M
+  M = {version = VERSION, buffers = old and old.buffers or {}}
+  M.augroup = vim.api.nvim_create_augroup('nvr_wait', {clear = true})
+
+  local function alive(chan)
+    return next(vim.api.nvim_get_chan_info(chan)) ~= nil
+  end
+
+  local function set_bvar(buf)
+    if not vim.api.nvim_buf_is_valid(buf) then
+      return
+    end
+    local chans = vim.tbl_filter(alive, vim.b[buf].nvr or {})
+    for chan in pairs(M.buffers[buf] or {}) do
+      if not vim.tbl_contains(chans, chan) then
+        table.insert(chans, 1, chan)
+      end
+    end
+    vim.b[buf].nvr = chans
+  end
+
+  local function buf_delete(buf)
+    local chans = M.buffers[buf] or {}
+    M.buffers[buf] = nil
+    for chan, count in pairs(chans) do
+      for _ = 1, count do
+        pcall(vim.rpcnotify, chan, 'BufDelete')
+      end
+    end
+  end
+
+  local function watch(buf)
+    vim.api.nvim_create_autocmd('BufDelete', {
+      group = M.augroup,
+      buffer = buf,
+      once = true,
+      callback = function() buf_delete(buf) end,
+    })
+  end
+
+  function M.cleanup()
+    for buf, chans in pairs(M.buffers) do
+      for chan in pairs(chans) do
+        if not alive(chan) then
+          chans[chan] = nil
+        end
+      end
+      if next(chans) == nil then
+        M.buffers[buf] = nil
+        vim.api.nvim_clear_autocmds({group = M.augroup, buffer = buf})
+      end
+    end
+  end
+
+  function M.register(chan, buf)
+    M.cleanup()
+    if not M.buffers[buf] then
+      M.buffers[buf] = {}
+      watch(buf)
+    end
+    M.buffers[buf][chan] = (M.buffers[buf][chan] or 0) + 1
+    set_bvar(buf)
+  end
+
+  vim.api.nvim_create_autocmd('VimLeave', {
+    group = M.augroup,
+    callback = function()
+      local code = vim.v.exiting
+      if type(code) ~= 'number' or code == 0 then
+        return
+      end
+      local notified = {}
+      for _, chans in pairs(M.buffers) do
+        for chan in pairs(chans) do
+          if not notified[chan] then
+            notified[chan] = true
+            pcall(vim.rpcnotify, chan, 'Exit', code)
+          end
+        end
+      end
+    end,
+  })
+
+  for buf in pairs(M.buffers) do
+    watch(buf)
+  end
+  package.loaded.nvr = M
+end
+'''
+
+
+# Registers the current buffer for the given channel.
+LUA_WAIT_FOR_CURRENT_BUFFER = LUA_WAIT_MODULE + r'''
+local chanid = ...
+M.register(chanid, vim.api.nvim_get_current_buf())
+'''
+
+
+# Opens a batch of files in one request. Each entry is a list of
+# [cmd, path, diffthis, waits, large]. Large files are opened without autocmds,
+# i.e. filetype detection, syntax and plugins, without swap file and without
+# undo history. Returns a list of [index, errmsg] for files that failed to
+# open. Stops at the first error that isn't E37.
+LUA_OPEN_FILES = LUA_WAIT_MODULE + r'''
+local chanid, files = ...
+local errors = {}
+
+for i, file in ipairs(files) do
+  local cmd, path, diffthis, waits, large = unpack(file)
+  if large then
+    cmd = 'noautocmd noswapfile ' .. cmd
+  end
+  local shortmess = vim.o.shortmess
+  vim.o.shortmess = (shortmess:gsub('F', ''))
+  local ok, err = pcall(vim.cmd, cmd .. ' ' .. vim.fn.fnameescape(path))
+  vim.o.shortmess = shortmess
+  if not ok then
+    table.insert(errors, {i, tostring(err)})
+    if not tostring(err):find('E37') then
+      return errors
+    end
+  elseif large then
+    vim.cmd('noautocmd setlocal undolevels=-1 syntax=OFF')
+  end
+  if diffthis then
+    vim.cmd('diffthis')
+  end
+  for _ = 1, waits do
+    M.register(chanid, vim.api.nvim_get_current_buf())
+  end
+end
+
+return errors
+'''
+
+
+# Appends lines to a buffer that follows stdin. The first chunk replaces the
+# empty line of the new buffer. With max, the oldest lines are dropped. Windows
+# whose cursor was on the last line scroll along. Returns false if the buffer
+# is gone.
+LUA_APPEND_LINES = r'''
+local buf, lines, first, max = ...
+if not vim.api.nvim_buf_is_loaded(buf) then
+  return false
+end
+local count = vim.api.nvim_buf_line_count(buf)
+local following = {}
+for _, win in ipairs(vim.fn.win_findbuf(buf)) do
+  if vim.api.nvim_win_get_cursor(win)[1] >= count then
+    table.insert(following, win)
+  end
+end
+local start = first and 0 or count
+vim.api.nvim_buf_set_lines(buf, start, -1, false, lines)
+count = start + #lines
+if max and count > max then
+  vim.api.nvim_buf_set_lines(buf, 0, count - max, false, {})
+  count = max
+end
+vim.bo[buf].modified = false
+for _, win in ipairs(following) do
+  vim.api.nvim_win_set_cursor(win, {count, 0})
+end
+return true
+'''
+
+
+# Edits a file in a --pool worker: runs the commands, writes the file if it
+# changed and wipes out the buffer. Returns an error message or nil.
+LUA_POOL_EDIT = r'''
+local path, cmds = ...
+local ok, err = pcall(function()
+  vim.cmd('silent edit ' .. vim.fn.fnameescape(path))
+  for _, cmd in ipairs(cmds) do
+    vim.cmd(cmd)
+  end
+  vim.cmd('silent update')
+end)
+pcall(vim.cmd, 'silent! bwipeout!')
+if not ok then
+  return tostring(err)
+end
+'''
+
+
+# Returns the number of the buffer given by its number, its name or "%", or -1
+# if there is no such buffer. The buffer gets loaded, so its lines can be read.
+LUA_FIND_BUFFER = r'''
+local name = ...
+local buf = name:match('^%d+$') and tonumber(name) or vim.fn.bufnr(name)
+if buf < 1 or vim.fn.bufexists(buf) == 0 then
+  return -1
+end
+vim.fn.bufload(buf)
+return buf
+'''
+
+
+# Adds a chunk of files as listed buffers without loading them. Buffers are
+# added via bufadd(), so the paths need no escaping. If cmd is given, the
+# first file is opened with it before the rest is added. Returns an error
+# message or nil.
+LUA_ADD_FILES = r'''
+local paths, cmd = ...
+local err
+if cmd then
+  local ok, e = pcall(vim.cmd, cmd .. ' ' .. vim.fn.fnameescape(paths[1]))
+  if not ok then
+    err = tostring(e)
+    if not err:find('E37') then
+      return err
+    end
+  end
+end
+for _, path in ipairs(paths) do
+  vim.bo[vim.fn.bufadd(path)].buflisted = true
+end
+return err
+'''
+
+
+# Adds a chunk of lines to the quickfix list. They are parsed relative to the
+# given directory using 'errorformat'. The first chunk creates a new list.
+# Unless jumped is true, jumps to the first error if the chunk contains one.
+# Returns whether it jumped by now.
+LUA_ADD_QUICKFIX = r'''
+local cwd, lines, first, jumped = ...
+vim.cmd('lcd ' .. vim.fn.fnameescape(cwd))
+local items = vim.fn.getqflist({lines = lines}).items
+vim.cmd('silent lcd -')
+vim.fn.setqflist({}, first and ' ' or 'a', {items = items})
+if not jumped then
+  for _, item in ipairs(items) do
+    if item.valid == 1 then
+      vim.cmd('cfirst')
+      return true
+    end
+  end
+end
+return jumped
+'''
+
+
+# Evaluates an expression and keeps the result in g:nvr_results, keyed by
+# channel, so that it can be fetched with nvim_eval() in pages. It never
+# passes through Lua, which would turn floats, Blobs and Funcrefs into
+# something else. Returns the length of a list result, otherwise -1. Results
+# kept for closed channels are dropped.
+LUA_EXPR_EVAL = r'''
+local chanid, expr = ...
+vim.cmd('let g:nvr_results = get(g:, "nvr_results", {})')
+for _, id in ipairs(vim.fn.eval('keys(g:nvr_results)')) do
+  if vim.tbl_isempty(vim.api.nvim_get_chan_info(tonumber(id))) then
+    vim.cmd('unlet g:nvr_results[' .. id .. ']')
+  end
+end
+local result = 'g:nvr_results[' .. chanid .. ']'
+vim.api.nvim_set_var('nvr_expr', expr)
+local ok, err = pcall(vim.cmd, 'let ' .. result .. ' = eval(g:nvr_expr)')
+vim.cmd('unlet g:nvr_expr')
+if not ok then
+  error(err, 0)
+end
+return vim.fn.eval('type(' .. result .. ') == v:t_list ? len(' .. result .. ') : -1')
+'''
+
+
+class Tracer():
+    """
+    Write the duration of every phase of a call and every RPC as JSON lines
+    to a file or stderr. Without a path, every method returns immediately.
+
+    Phases follow each other: starting a phase ends the previous one.
+    """
+    def __init__(self, path=None):
+        self.file = None
+        self.current = None
+        if path in ('-', '1'):
+            self.file = sys.stderr
+        elif path:
+            self.file = open(path, 'a')
+
+    def emit(self, **record):
+        import json
+        record['pid'] = os.getpid()
+        self.file.write(json.dumps(record) + '\n')
+        self.file.flush()
+
+    def phase(self, name):
+        if not self.file:
+            return
+        now = time.perf_counter()
+        self.finish(now)
+        self.current = (name, now)
+
+    def finish(self, now=None):
+        if not self.file or not self.current:
+            return
+        name, start = self.current
+        self.current = None
+        self.emit(type='phase', name=name, ms=round(((now or time.perf_counter()) - start) * 1000, 3))
+
+    def wrap(self, server):
+        """
+        Record every request sent via server.request(). pynvim and
+        rpc.Client send all requests through that method, e.g. command(),
+        eval() and funcs.
+        """
+        if not self.file:
+            return
+        import msgpack
+
+        def size(obj):
+            try:
+                return len(msgpack.packb(obj, default=str))
+            except Exception:
+                return None
+
+        request = server.request
+        def traced_request(name, *args, **kwargs):
+            start = time.perf_counter()
+            result, error = None, None
+            try:
+                result = request(name, *args, **kwargs)
+                return result
+            except Exception as e:
+                error = str(e)
+                raise
+            finally:
+                record = {
+                    'type': 'rpc',
+                    'method': name,
+                    'args_bytes': size(list(args)),
+                    'result_bytes': size(result),
+                    'ms': round((time.perf_counter() - start) * 1000, 3),
+                }
+                if error is not None:
+                    record['error'] = error
+                self.emit(**record)
+        server.request = traced_request
+
 
 class Nvr():
     def __init__(self, address, silent=False):
         self.address = address
         self.server = None
+        self.tracer = Tracer()
         self.silent = silent
         self.wait = 0
         self.started_new_process = False
         self.handled_first_buffer = False
         self.diffmode = False
+        self.chunksize = 10000
+        self.connect_timeout = 1
+        self.response_timeout = 5
+        # Why attaching failed.
+        self.error = None
+        # Only pynvim can wait for the notifications of --remote-wait.
+        self.use_pynvim = False
+        self.ready = None
+        # With --pipeline, calls whose results aren't needed right away are
+        # queued here as ([method, args], callback) until flush().
+        self.pending = None
+        self.follow = False
+        self.max_lines = None
+        # Files of at least that many bytes are opened in large-file mode.
+        self.large_size = None
 
     def attach(self):
+        """
+        Attach to the server. Unless use_pynvim is set, this uses the built-in
+        client, which is much cheaper to import and set up than pynvim. Give
+        up after connect_timeout seconds, and if the first response takes
+        longer than response_timeout seconds.
+        """
+        try:
+            if self.use_pynvim:
+                self.server = self.attach_pynvim()
+            else:
+                from nvr.rpc import Client
+                self.server = Client.connect(self.address, self.connect_timeout, self.response_timeout)
+            self.tracer.wrap(self.server)
+        except OSError as e:
+            # Invalid addresses, stale sockets and servers that don't respond.
+            self.error = e
+
+    def attach_pynvim(self):
+        """
+        pynvim waits for the api info right away, so both deadlines are
+        covered by a single alarm.
+        """
+        import pynvim
+
+        timeout = self.connect_timeout + self.response_timeout
+        def on_timeout(signum, frame):
+            raise TimeoutError(f'No response from {self.address} within {timeout}s.')
+
+        handler = None
+        if timeout and hasattr(signal, 'setitimer'):
+            try:
+                handler = signal.signal(signal.SIGALRM, on_timeout)
+                signal.setitimer(signal.ITIMER_REAL, timeout)
+            except ValueError:
+                # Signals only work in the main thread.
+                pass
         try:
             socktype, address, port = parse_address(self.address)
             if socktype == 'tcp':
-                self.server = pynvim.attach('tcp', address=address, port=int(port))
-            else:
-                self.server = pynvim.attach('socket', path=address)
+                return pynvim.attach('tcp', address=address, port=int(port))
+            return pynvim.attach('socket', path=address)
+        finally:
+            if handler is not None:
+                signal.setitimer(signal.ITIMER_REAL, 0)
+                signal.signal(signal.SIGALRM, handler)
+
+    def is_stale(self):
+        """
+        The address is a Unix domain socket that nobody listens on anymore,
+        e.g. because nvim crashed. Connecting to it fails immediately with
+        ECONNREFUSED, which is also the error for files that aren't sockets.
+        """
+        import stat
+        socktype, path, _ = parse_address(self.address)
+        if socktype != 'socket' or not isinstance(self.error, ConnectionRefusedError):
+            return False
+        try:
+            return stat.S_ISSOCK(os.stat(path).st_mode)
         except OSError:
-            # Ignore invalid addresses.
-            pass
+            return False
+
+    def wait_for_server(self, timeout):
+        """
+        Attach to a freshly started nvim process as soon as it accepts
+        connections. For Unix domain sockets an inotify watch on the socket's
+        directory wakes us up when the socket gets created. Otherwise, and in
+        case the socket exists but nvim isn't listening yet, retry with
+        exponential backoff until the deadline.
+        """
+        delays = backoff(timeout)
+        socktype, address, _ = parse_address(self.address)
+        watch = None
+        if socktype == 'socket':
+            watch = inotify_watch(os.path.dirname(os.path.abspath(address)))
+        try:
+            while True:
+                self.attach()
+                if self.server:
+                    return True
+                delay = next(delays, None)
+                if delay is None:
+                    return False
+                if watch is None:
+                    time.sleep(delay)
+                else:
+                    wait_for_inotify(watch, delay)
+        finally:
+            if watch is not None:
+                os.close(watch)
 
     def try_attach(self, args, nvr, options, arguments):
-        for i in range(10):
-            self.attach()
-            if self.server:
-                self.started_new_process = True
-                return proceed_after_attach(nvr, options, arguments)
-            time.sleep(0.2)
+        timeout = start_timeout()
+        # A new process might be busy with its config for a while.
+        self.response_timeout = max(self.response_timeout, timeout)
+        if self.wait_for_server(timeout):
+            self.started_new_process = True
+            proceed_after_attach(nvr, options, arguments)
+            self.server.close()
+            return
         print(f'[!] Unable to attach to the new nvim process. Is `{" ".join(args)}` working?')
         sys.exit(1)
 
@@ -73,84 +535,325 @@ class Nvr():
                     Use --nostart to avoid starting a new process.
             '''))
 
-        args = os.environ.get('NVR_CMD')
-        args = args.split(' ') if args else ['nvim']
-        args.extend(['--listen', self.address])
+        args = nvim_cmd() + ['--listen', self.address]
 
-        multiprocessing.Process(target=self.try_attach, args=(args[0], nvr, options, arguments)).start()
+        # The child attaches to the new process and handles all options,
+        # while this process turns into nvim.
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            exitcode = 1
+            try:
+                self.try_attach(args, nvr, options, arguments)
+                exitcode = 0
+            except SystemExit as e:
+                exitcode = e.code if type(e.code) is int else 1
+            finally:
+                sys.stdout.flush()
+                sys.stderr.flush()
+                os._exit(exitcode)
 
         try:
             os.execvpe(args[0], args, os.environ)
         except FileNotFoundError:
+            os.kill(pid, signal.SIGTERM)
             print(f'[!] Can\'t start new nvim process: `{args[0]}` is not in $PATH.')
             sys.exit(1)
 
+    def request(self, callback, method, *args):
+        """
+        Send a request and pass its result to callback, if given. When
+        pipelining, queue it instead.
+        """
+        if self.pending is None:
+            result = self.server.request(method, *args)
+            if callback:
+                callback(result)
+        else:
+            self.pending.append(([method, list(args)], callback))
+
+    def command(self, cmd):
+        self.request(None, 'nvim_command', cmd)
+
+    def input(self, keys):
+        self.request(None, 'nvim_input', keys)
+
+    def flush(self):
+        """
+        Send all queued requests in a single nvim_call_atomic request and
+        pass their results on. nvim stops at the first request that fails,
+        so everything after it is skipped.
+        """
+        if not self.pending:
+            return
+        pending, self.pending = self.pending, []
+        results, error = self.server.request('nvim_call_atomic', [call for (call, _) in pending])
+        for (_, callback), result in zip(pending, results):
+            if callback:
+                callback(result)
+        if error:
+            _, _, message = error
+            raise self.server.error(message)
+
     def read_stdin_into_buffer(self, cmd):
+        self.flush()
+        if self.follow:
+            self.follow_stdin(cmd)
+            return
         self.server.command(cmd)
-        for line in sys.stdin:
-            self.server.funcs.append('$', line[:-1])
-        self.server.command('silent 1delete _ | set nomodified')
-
-    def fnameescaped_command(self, cmd, path):
-        if not is_netrw_protocol(path):
-            path = os.path.abspath(path)
-        path = self.server.funcs.fnameescape(path)
-        shortmess = self.server.options['shortmess']
-        self.server.options['shortmess'] = shortmess.replace('F', '')
-        self.server.command(f'{cmd} {path}')
-        self.server.options['shortmess'] = shortmess
+        # Stick to the new buffer, even if the user switches to another one
+        # while a large input is still arriving.
+        buf = self.server.request('nvim_get_current_buf')
+        # The first chunk replaces the empty line of the new buffer.
+        start = 0
+        for lines in read_chunks(sys.stdin.buffer, self.chunksize):
+            self.server.request('nvim_buf_set_lines', buf, start, -1, False, lines)
+            start += len(lines)
+        self.server.exec_lua('vim.bo[...].modified = false', buf)
+
+    def follow_stdin(self, cmd):
+        """
+        Append stdin to a new buffer as it arrives, until EOF or the buffer
+        gets unloaded. Lines are collected until FOLLOW_INTERVAL passed or
+        chunksize lines arrived and then sent in one request, so nvim isn't
+        flooded with requests when the input is fast.
+        """
+        import select
+
+        self.server.command(cmd)
+        buf = self.server.request('nvim_get_current_buf')
+        fd = sys.stdin.buffer.fileno()
+        lines = []
+        rest = b''
+        first = True
+        deadline = None
+        eof = False
+
+        while not eof:
+            timeout = None if deadline is None else max(0, deadline - time.monotonic())
+            if select.select([fd], [], [], timeout)[0]:
+                block = os.read(fd, 65536)
+                if block:
+                    parts = (rest + block).split(b'\n')
+                    rest = parts.pop()
+                    lines.extend(parts)
+                else:
+                    eof = True
+                    if rest:
+                        lines.append(rest)
+                if lines and deadline is None:
+                    deadline = time.monotonic() + FOLLOW_INTERVAL
+            if lines and (eof or len(lines) >= self.chunksize or time.monotonic() >= deadline):
+                for start in range(0, len(lines), self.chunksize):
+                    chunk = lines[start:start + self.chunksize]
+                    if not self.server.exec_lua(LUA_APPEND_LINES, buf, chunk, first, self.max_lines):
+                        return
+                    first = False
+                lines = []
+                deadline = None
+
+    def read_buffer(self, name):
+        """
+        Write the lines of a buffer to stdout as they are, fetching chunksize
+        lines at a time. Stops quietly if the reader goes away, e.g. head.
+        """
+        self.flush()
+        buf = self.server.exec_lua(LUA_FIND_BUFFER, name)
+        if buf < 0:
+            print(f'[!] No such buffer: {name}', file=sys.stderr)
+            sys.exit(1)
+
+        sys.stdout.flush()
+        out = sys.stdout.buffer
+        start = 0
+        try:
+            while True:
+                lines = self.server.request('nvim_buf_get_lines', buf, start, start + self.chunksize, False)
+                if not lines:
+                    break
+                out.write('\n'.join(lines).encode(errors='surrogateescape') + b'\n')
+                out.flush()
+                if len(lines) < self.chunksize:
+                    break
+                start += len(lines)
+        except BrokenPipeError:
+            # Python would complain about the broken pipe once more when
+            # flushing stdout at exit.
+            devnull = os.open(os.devnull, os.O_WRONLY)
+            os.dup2(devnull, sys.stdout.fileno())
+            sys.exit(1)
+
+    def open_files(self, files):
+        if not files:
+            return
+        def check(errors):
+            for _, err in errors:
+                check_error(err)
+        waits = sum(waits for (_, _, _, waits, _) in files)
+        # Only fetch the channel id if it's needed, since the built-in client
+        # has to ask nvim for it.
+        chanid = self.server.channel_id if waits else 0
+        self.request(check, 'nvim_exec_lua', LUA_OPEN_FILES, [chanid, files])
+        self.wait += waits
+
+    def add_files(self, arguments):
+        """
+        Add files as listed, but unloaded buffers in chunks of chunksize
+        paths and only open the first one. Filetype detection, syntax and
+        BufRead autocmds run once the buffer gets visited.
+        """
+        cmds, files = split_cmds_from_files(arguments)
+        if '-' in files:
+            print('[!] --remote-add can\'t read from stdin.', file=sys.stderr)
+            sys.exit(1)
+
+        paths = [f if is_netrw_protocol(f) else os.path.abspath(f) for f in files]
+        for start in range(0, len(paths), self.chunksize):
+            self.request(check_error, 'nvim_exec_lua', LUA_ADD_FILES,
+                         [paths[start:start + self.chunksize], 'edit' if start == 0 else None])
+
+        for cmd in cmds:
+            self.command(cmd if cmd else '$')
+
+        return len(files)
+
+    def load_quickfix(self, f):
+        # Jump to the first error as soon as the chunk containing it arrived,
+        # so one can start navigating while the rest is still loading. Build
+        # logs often start with more noise than fits into a chunk.
+        self.flush()
+        first, jumped = True, False
+        for lines in read_chunks(f, self.chunksize):
+            lines = [line.rstrip() for line in lines]
+            jumped = self.server.exec_lua(LUA_ADD_QUICKFIX, os.environ['PWD'], lines, first, jumped)
+            first = False
+        if first:
+            self.server.exec_lua(LUA_ADD_QUICKFIX, os.environ['PWD'], [], first, jumped)
+        if not jumped:
+            # Without errors, that's the first line, like :cfile does.
+            self.server.command('cfirst')
+
+    def eval_paged(self, expr):
+        """
+        Evaluate expr. Returns a tuple of pages and result. If the result is
+        a list, pages is an iterator over lists of at most chunksize items,
+        which are fetched from nvim one by one, and result is None.
+        Otherwise pages is None.
+        """
+        self.flush()
+        chanid = self.server.channel_id
+        length = self.server.exec_lua(LUA_EXPR_EVAL, chanid, expr)
+        if length < 0:
+            return None, self.server.eval(f'remove(g:nvr_results, {chanid})')
+        def pages(length):
+            done = False
+            try:
+                for start in range(0, length, self.chunksize):
+                    end = start + self.chunksize
+                    if end < length:
+                        yield self.server.eval(f'g:nvr_results[{chanid}][{start} : {end - 1}]')
+                    else:
+                        # The last page drops the result.
+                        yield self.server.eval(f'remove(g:nvr_results, {chanid})[{start} :]')
+                done = True
+            finally:
+                if not done:
+                    try:
+                        self.server.command(f'silent! unlet g:nvr_results[{chanid}]')
+                    except Exception:
+                        # Don't hide the error that aborted paging.
+                        pass
+        return pages(length), None
 
     def diffthis(self):
         if self.diffmode:
-            self.server.command('diffthis')
+            self.command('diffthis')
             if not self.started_new_process:
                 self.wait_for_current_buffer()
 
     def wait_for_current_buffer(self):
-        bvars = self.server.current.buffer.vars
-        chanid = self.server.channel_id
-
-        self.server.command('augroup nvr')
-        self.server.command(f'autocmd BufDelete <buffer> silent! call rpcnotify({chanid}, "BufDelete")')
-        self.server.command(f'autocmd VimLeave * if exists("v:exiting") && v:exiting > 0 | silent! call rpcnotify({chanid}, "Exit", v:exiting) | endif')
-        self.server.command('augroup END')
-
-        if 'nvr' in bvars:
-            if chanid not in bvars['nvr']:
-                bvars['nvr'] = [chanid] + bvars['nvr']
-        else:
-            bvars['nvr'] = [chanid]
-
+        self.request(None, 'nvim_exec_lua', LUA_WAIT_FOR_CURRENT_BUFFER, [self.server.channel_id])
         self.wait += 1
 
+    def is_large(self, path):
+        # netrw reads files via autocmds, so it needs them.
+        if self.large_size is None or is_netrw_protocol(path) or path.endswith(DECODED_SUFFIXES):
+            return False
+        if self.large_size == 0:
+            return True
+        try:
+            return os.stat(path).st_size >= self.large_size
+        except OSError:
+            return False
+
     def execute(self, arguments, cmd='edit', silent=False, wait=False):
         cmds, files = split_cmds_from_files(arguments)
 
+        # All files between two occurrences of '-' are opened in one batch.
+        batch = []
+        waits = int(self.diffmode and not self.started_new_process) + int(wait)
+
         for fname in files:
             if fname == '-':
+                self.open_files(batch)
+                batch = []
                 self.read_stdin_into_buffer(stdin_cmd(cmd))
+                self.diffthis()
+                if wait:
+                    self.wait_for_current_buffer()
             else:
-                try:
-                    if self.started_new_process and not self.handled_first_buffer:
-                        self.fnameescaped_command('edit', fname)
-                        self.handled_first_buffer = True
-                    else:
-                        self.fnameescaped_command(cmd, fname)
-                except pynvim.api.nvim.NvimError as e:
-                    if not re.search('E37', e.args[0].decode()):
-                        traceback.print_exc()
-                        sys.exit(1)
-            self.diffthis()
-
-            if wait:
-                self.wait_for_current_buffer()
+                if self.started_new_process and not self.handled_first_buffer:
+                    fcmd = 'edit'
+                    self.handled_first_buffer = True
+                else:
+                    fcmd = cmd
+                if not is_netrw_protocol(fname):
+                    fname = os.path.abspath(fname)
+                batch.append([fcmd, fname, self.diffmode, waits, self.is_large(fname)])
+
+        self.open_files(batch)
 
         for cmd in cmds:
-            self.server.command(cmd if cmd else '$')
+            self.command(cmd if cmd else '$')
 
         return len(files)
 
 
+def nvim_cmd():
+    # The command that starts a new nvim process, without --listen.
+    args = os.environ.get('NVR_CMD')
+    return args.split(' ') if args else ['nvim']
+
+
+def start_timeout():
+    # Seconds to wait for a new nvim process to accept connections.
+    return float(os.environ.get('NVR_START_TIMEOUT', 10))
+
+
+def backoff(timeout, delay=0.005, maximum=0.5):
+    """
+    Yield how long to wait before the next attempt, doubling the delay up to
+    maximum, until timeout seconds passed.
+    """
+    deadline = time.monotonic() + timeout
+    while True:
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            return
+        yield min(delay, remaining)
+        delay = min(delay * 2, maximum)
+
+
+def check_error(err):
+    # Errors other than E37 (no write since last change) end the call.
+    if err:
+        err = err.decode() if type(err) is bytes else err
+        if not re.search('E37', err):
+            print(err, file=sys.stderr)
+            sys.exit(1)
+
+
 def stdin_cmd(cmd):
     return {
             'edit': 'enew',
@@ -160,6 +863,63 @@ def stdin_cmd(cmd):
             }[cmd]
 
 
+def inotify_watch(directory):
+    """
+    Return an inotify file descriptor that becomes readable when a file gets
+    created in the given directory, or None if inotify is not available.
+    """
+    if not sys.platform.startswith('linux'):
+        return None
+    import ctypes
+    try:
+        libc = ctypes.CDLL(None, use_errno=True)
+        fd = libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    except (OSError, AttributeError):
+        return None
+    if fd < 0:
+        return None
+    IN_MOVED_TO, IN_CREATE = 0x80, 0x100
+    if libc.inotify_add_watch(fd, os.fsencode(directory), IN_MOVED_TO | IN_CREATE) < 0:
+        os.close(fd)
+        return None
+    return fd
+
+
+def wait_for_inotify(fd, timeout):
+    import select
+    if select.select([fd], [], [], timeout)[0]:
+        try:
+            while os.read(fd, 4096):
+                pass
+        except BlockingIOError:
+            pass
+
+
+def read_chunks(f, size, blocksize=65536):
+    """
+    Read a binary file object in blocks and yield lists of at most `size`
+    lines without their trailing newlines. A missing newline at the end of
+    the input doesn't drop the last line.
+    """
+    lines = []
+    rest = b''
+    while True:
+        block = f.read(blocksize)
+        if not block:
+            break
+        parts = (rest + block).split(b'\n')
+        rest = parts.pop()
+        lines.extend(parts)
+        while len(lines) >= size:
+            yield lines[:size]
+            lines = lines[size:]
+    if rest:
+        lines.append(rest)
+    while lines:
+        yield lines[:size]
+        lines = lines[size:]
+
+
 def is_netrw_protocol(path):
     protocols = [
             re.compile('^davs?://*'),
@@ -176,6 +936,14 @@ def is_netrw_protocol(path):
 
 
 def parse_args(argv):
+    import argparse
+
+    def positive(value):
+        number = int(value)
+        if number < 1:
+            raise argparse.ArgumentTypeError(f'must be at least 1: {value}')
+        return number
+
     form_class = argparse.RawDescriptionHelpFormatter
     usage      = argv[0] + ' [arguments]'
     epilog     = 'Development: https://github.com/mhinz/neovim-remote\n\nHappy hacking!'
@@ -248,6 +1016,11 @@ def parse_args(argv):
             metavar = '<file>',
             help    = 'Like --remote-wait-silent, but use :tabedit.')
 
+    parser.add_argument('--remote-add',
+            nargs   = '*',
+            metavar = '<file>',
+            help    = 'Add files to the buffer list without loading them and only open the first one. Much faster than --remote for thousands of files.')
+
     parser.add_argument('--remote-send',
             metavar = '<keys>',
             help    = 'Send key presses.')
@@ -255,9 +1028,49 @@ def parse_args(argv):
             metavar = '<expr>',
             help    = 'Evaluate expression and print result in shell.')
 
+    parser.add_argument('--remote-read',
+            metavar = '<buffer>',
+            help    = 'Print the lines of a buffer, given by its number, its name or "%%" for the current one. Lines are fetched in pieces of --chunk-size lines.')
+
+    parser.add_argument('--output',
+            choices = ['json', 'ndjson', 'raw'],
+            help    = 'Print the result of --remote-expr as JSON, as JSON with one list item per line (ndjson), or one list item per line with strings as they are (raw). Lists are printed item by item.')
+    parser.add_argument('--paged',
+            action  = 'store_true',
+            help    = 'Keep a list result of --remote-expr in nvim and fetch it in pieces of --chunk-size items, so that nvr never holds the whole list. Implies --output ndjson, unless given.')
+
     parser.add_argument('--servername',
+            action  = 'append',
             metavar = '<addr>',
-            help    = 'Set the address to be used. This overrides the default "/tmp/nvimsocket" and $NVIM_LISTEN_ADDRESS.')
+            help    = 'Set the address to be used. This overrides the default "/tmp/nvimsocket" and $NVIM_LISTEN_ADDRESS. If given several times, -cc, -c, -l, --remote-send and --remote-expr are sent to all of them concurrently.')
+    parser.add_argument('--all',
+            action  = 'store_true',
+            help    = 'Send -cc, -c, -l, --remote-send and --remote-expr to all nvim processes found by --serverlist concurrently.')
+    parser.add_argument('--timeout',
+            type    = float,
+            metavar = '<seconds>',
+            help    = 'Give up on a server that does not respond in time. For a single server, only the first response counts. With --pool, every request to a worker counts. Default: 5, or 1 for --ping.')
+    parser.add_argument('--connect-timeout',
+            type    = float,
+            default = 1,
+            metavar = '<seconds>',
+            help    = 'Give up if connecting to the server takes longer, e.g. for an unreachable host. Default: 1.')
+    parser.add_argument('--reclaim',
+            action  = 'store_true',
+            help    = 'If nobody listens on the Unix domain socket anymore, e.g. because nvim crashed, remove it and start a new nvim process there.')
+    parser.add_argument('--target',
+            choices = ['default', 'auto'],
+            default = 'default',
+            help    = 'How to choose the server if --servername is not given. "default" uses $NVIM, $NVIM_LISTEN_ADDRESS or "/tmp/nvimsocket". "auto" uses the known server whose working directory or git root contains the files to open (or the current directory). Default: default.')
+    parser.add_argument('--ping',
+            nargs   = '*',
+            metavar = '<addr>',
+            help    = 'Measure the round-trip time to the given servers, or all nvim processes found by --serverlist. Servers that wait for input or don\'t respond within --timeout are reported as blocked or stuck. Use --output json for JSON.')
+    parser.add_argument('--count',
+            type    = positive,
+            default = 10,
+            metavar = '<n>',
+            help    = 'Number of requests per server for --ping. Default: 10.')
     parser.add_argument('--serverlist',
             action  = 'store_true',
             help    = 'Print the TCPv4 and Unix domain socket addresses of all nvim processes.')
@@ -297,9 +1110,56 @@ def parse_args(argv):
     parser.add_argument('-t',
             metavar = '<tag>',
             help    = 'Jump to file and position of given tag.')
+    parser.add_argument('--chunk-size',
+            type    = positive,
+            default = 10000,
+            metavar = '<lines>',
+            help    = 'Maximum number of lines transferred per request, e.g. when reading from stdin. Default: 10000.')
+    parser.add_argument('--follow',
+            action  = 'store_true',
+            help    = 'When reading from stdin via "-", append to the buffer as data arrives until EOF, e.g. `tail -f log | nvr --follow -`. Windows with the cursor on the last line scroll along.')
+    parser.add_argument('--max-lines',
+            type    = positive,
+            metavar = '<lines>',
+            help    = 'With --follow, keep at most that many lines and drop the oldest ones.')
+    parser.add_argument('--large-size',
+            type    = float,
+            default = 100,
+            metavar = '<MiB>',
+            help    = 'Open files of at least that size in large-file mode: without autocmds (filetype detection, syntax, plugins), swap file and undo history. Compressed files and archives are excluded, since they are decoded by autocmds. Default: 100.')
+    parser.add_argument('--large',
+            action  = 'store_true',
+            help    = 'Open all files in large-file mode, regardless of their size.')
     parser.add_argument('--nostart',
             action  = 'store_true',
             help    = 'If no process is found, do not start a new one.')
+    parser.add_argument('--trace',
+            nargs   = '?',
+            const   = '-',
+            metavar = '<file>',
+            help    = 'Append the duration of every phase and RPC as JSON lines to <file>, or stderr if not given. $NVR_TRACE does the same.')
+    parser.add_argument('--pool',
+            type    = positive,
+            metavar = '<n>',
+            help    = 'Edit the given files with <n> headless nvim processes in parallel, instead of using a server. Each process runs -cc once, and then -c on every file it takes, before writing it.')
+    parser.add_argument('--pipeline',
+            action  = 'store_true',
+            help    = 'Queue -cc, -c, -l, --remote-send and opening files, instead of waiting for each of them, and send them in one request when a result is needed or at the end. Errors are reported at that point.')
+    parser.add_argument('--batch',
+            metavar = '<file>',
+            help    = 'Run one nvr command line per line of <file>, or stdin if "-", over a single connection. Consecutive lines that only use -cc, -c, -l and --remote-send are sent in one request. Every line gets a status with its line number on stderr: ok or the error. Can\'t be combined with options that act on the server.')
+    parser.add_argument('--stats',
+            nargs   = '?',
+            const   = 'all',
+            metavar = '<window>',
+            help    = 'Print per-operation percentiles and histograms of the calls recorded within the time window, e.g. 30m, 12h or 7d. Default: all. Calls are recorded if $NVR_STATS is "1" or a path. Use --output json for JSON.')
+    parser.add_argument('--daemon',
+            action  = 'store_true',
+            help    = 'Run a broker that keeps connections to nvim processes open and handles subsequent nvr calls. Calls it can\'t handle fall back to the usual way.')
+    parser.add_argument('--complete',
+            nargs   = '+',
+            metavar = '<context>',
+            help    = 'Print completions for shell completion scripts, either "servers" or "buffers [<addr>]". Both are served from a cache. Must be the first argument.')
     parser.add_argument('--version',
             action  = 'store_true',
             help    = 'Show the nvr version.')
@@ -360,41 +1220,252 @@ def split_cmds_from_files(args):
 
 
 def print_versions():
-    import pkg_resources
-    print('nvr ' + pkg_resources.require("neovim-remote")[0].version)
-    print('pynvim ' + pkg_resources.require('pynvim')[0].version)
-    print('psutil ' + pkg_resources.require('psutil')[0].version)
+    try:
+        from importlib.metadata import version
+    except ImportError:
+        # Python 3.7
+        import pkg_resources
+        def version(name):
+            return pkg_resources.require(name)[0].version
+    print('nvr ' + version('neovim-remote'))
+    print('pynvim ' + version('pynvim'))
+    print('psutil ' + version('psutil'))
     print('Python ' + sys.version.split('\n')[0])
 
 
-def print_addresses():
-    addresses = []
+def find_addresses_psutil(name='nvim'):
+    import psutil
+
+    servers = []
     errors = []
 
     for proc in psutil.process_iter(attrs=['name']):
-        if proc.info['name'] == 'nvim':
+        if proc.info['name'] == name:
             try:
                 for conn in proc.connections('inet4'):
-                    addresses.insert(0, ':'.join(map(str, conn.laddr)))
+                    servers.append((proc.pid, ':'.join(map(str, conn.laddr))))
                 for conn in proc.connections('inet6'):
-                    addresses.insert(0, ':'.join(map(str, conn.laddr)))
+                    servers.append((proc.pid, ':'.join(map(str, conn.laddr))))
                 try:
                     for conn in proc.connections('unix'):
                         if conn.laddr:
-                            addresses.insert(0, conn.laddr)
+                            servers.append((proc.pid, conn.laddr))
                 except FileNotFoundError:
                     # Windows does not support Unix domain sockets and WSL1
                     # does not implement /proc/net/unix
                     pass
             except psutil.AccessDenied:
-                errors.insert(0, f'Access denied for nvim ({proc.pid})')
+                errors.append(f'Access denied for {name} ({proc.pid})')
+
+    return servers, errors
+
+
+def decode_proc_net_address(address, family):
+    import base64
+    import socket
+    import struct
+
+    ip, port = address.split(':')
+    ip = base64.b16decode(ip)
+    if family == socket.AF_INET:
+        ip = ip[::-1]
+    else:
+        ip = struct.pack('>4I', *struct.unpack('<4I', ip))
+    return f'{socket.inet_ntop(family, ip)}:{int(port, 16)}'
+
+
+def read_proc_net_sockets():
+    """
+    Map the inodes of all sockets to their local addresses. Every file in
+    /proc/net is only read once.
+    """
+    import socket
+
+    sockets = {}
+    for kind, family in [('tcp', socket.AF_INET), ('udp', socket.AF_INET),
+                         ('tcp6', socket.AF_INET6), ('udp6', socket.AF_INET6)]:
+        try:
+            with open(f'/proc/net/{kind}') as f:
+                next(f)
+                for line in f:
+                    fields = line.split()
+                    sockets[fields[9]] = decode_proc_net_address(fields[1], family)
+        except FileNotFoundError:
+            # IPv6 might be disabled.
+            pass
+    try:
+        with open('/proc/net/unix') as f:
+            next(f)
+            for line in f:
+                fields = line.split(None, 7)
+                if len(fields) == 8:
+                    sockets[fields[6]] = fields[7].rstrip('\n')
+    except FileNotFoundError:
+        # WSL1 does not implement /proc/net/unix
+        pass
+    return sockets
+
+
+def find_addresses_proc(name='nvim', jobs=1):
+    sockets = read_proc_net_sockets()
+
+    pids = []
+    for pid in os.listdir('/proc'):
+        if pid.isdigit():
+            try:
+                with open(f'/proc/{pid}/comm') as f:
+                    if f.read().rstrip('\n') == name:
+                        pids.append(int(pid))
+            except OSError:
+                # The process is already gone.
+                pass
+
+    def scan(pid):
+        addresses = []
+        try:
+            fds = os.listdir(f'/proc/{pid}/fd')
+        except PermissionError:
+            return None
+        except FileNotFoundError:
+            return []
+        for fd in fds:
+            try:
+                link = os.readlink(f'/proc/{pid}/fd/{fd}')
+            except OSError:
+                continue
+            if link.startswith('socket:['):
+                address = sockets.get(link[8:-1])
+                if address:
+                    addresses.append(address)
+        return addresses
+
+    if jobs > 1:
+        from concurrent.futures import ThreadPoolExecutor
+        with ThreadPoolExecutor(jobs) as executor:
+            results = list(executor.map(scan, pids))
+    else:
+        results = map(scan, pids)
 
-    for addr in sorted(addresses):
+    servers = []
+    errors = []
+    for pid, addresses in zip(pids, results):
+        if addresses is None:
+            errors.append(f'Access denied for {name} ({pid})')
+        else:
+            servers.extend((pid, address) for address in addresses)
+    return servers, errors
+
+
+def find_addresses():
+    """
+    Return a list of (pid, address) tuples of all nvim processes and a list
+    of errors. On Linux, /proc is scanned directly, which is much faster than
+    using psutil. Set $NVR_SERVERLIST_JOBS to scan the processes in parallel.
+    """
+    if sys.platform.startswith('linux') and os.path.isdir('/proc/net'):
+        return find_addresses_proc(jobs=int(os.environ.get('NVR_SERVERLIST_JOBS', 1)))
+    return find_addresses_psutil()
+
+
+def print_addresses(env=os.environ):
+    from nvr import registry
+    servers, errors = find_addresses()
+    registry.update_from_scan(servers, env)
+    for addr in sorted(address for (_, address) in servers):
         print(addr)
     for error in sorted(errors):
         print(error, file=sys.stderr)
 
 
+def all_addresses():
+    # A process can listen on several addresses, but must only be reached
+    # once. Prefer the one that sorts first, i.e. a socket over a TCP address.
+    servers, errors = find_addresses()
+    for error in sorted(errors):
+        print(error, file=sys.stderr)
+    by_pid = {}
+    for pid, address in servers:
+        by_pid[pid] = min(by_pid.get(pid, address), address)
+    return sorted(set(by_pid.values()))
+
+
+def percentile(samples, p):
+    # Nearest rank: the smallest sample that at least p percent of all
+    # samples are less than or equal to.
+    import math
+    samples = sorted(samples)
+    index = max(0, min(len(samples) - 1, math.ceil(p * len(samples) / 100) - 1))
+    return samples[index]
+
+
+def ping(addresses, options):
+    """
+    Measure the round-trip time of no-op requests to several servers
+    concurrently. A server that is waiting for input, e.g. at a "Press ENTER"
+    prompt, is reported as blocked, and one that doesn't answer in time as
+    stuck.
+    """
+    import asyncio
+    from nvr.rpc import AsyncClient
+
+    timeout = options.timeout or 1
+
+    async def probe(address):
+        report = {'address': address, 'status': 'ok'}
+        start = time.perf_counter()
+        try:
+            client = await asyncio.wait_for(AsyncClient.connect(address), timeout)
+        except asyncio.TimeoutError:
+            report['status'] = 'stuck'
+            return report
+        except OSError as e:
+            report['status'] = 'unreachable'
+            report['error'] = e.strerror or str(e)
+            return report
+        report['connect_ms'] = round((time.perf_counter() - start) * 1000, 3)
+        try:
+            # nvim answers nvim_get_mode even when it's waiting for input.
+            mode = await asyncio.wait_for(client.request('nvim_get_mode'), timeout)
+            if mode.get('blocking'):
+                report['status'] = 'blocked'
+                report['mode'] = mode.get('mode')
+                return report
+            # Unlike nvim_get_mode, nvim_eval has to wait for the main loop.
+            samples = []
+            for _ in range(options.count):
+                start = time.perf_counter()
+                await asyncio.wait_for(client.request('nvim_eval', '0'), timeout)
+                samples.append((time.perf_counter() - start) * 1000)
+            for name, value in [('min', min(samples)),
+                                ('p50', percentile(samples, 50)),
+                                ('p99', percentile(samples, 99))]:
+                report[name] = round(value, 3)
+        except asyncio.TimeoutError:
+            report['status'] = 'stuck'
+        except Exception as e:
+            report['status'] = 'error'
+            report['error'] = str(e)
+        finally:
+            await client.close()
+        return report
+
+    async def probe_all():
+        return await asyncio.gather(*(probe(address) for address in addresses))
+
+    reports = asyncio.run(probe_all())
+
+    if options.output in ('json', 'ndjson'):
+        print_pages([reports], options.output)
+    else:
+        width = max(len(a) for a in addresses + ['ADDRESS'])
+        print(f'{"ADDRESS":<{width}}  {"STATUS":<11}  {"MIN":>8}  {"P50":>8}  {"P99":>8}')
+        for report in reports:
+            columns = [f'{report[k]:8.3f}' if k in report else f'{"-":>8}' for k in ['min', 'p50', 'p99']]
+            print(f'{report["address"]:<{width}}  {report["status"]:<11}  ' + '  '.join(columns))
+    if any(report['status'] != 'ok' for report in reports):
+        sys.exit(1)
+
+
 def parse_address(address):
     try:
         host, port = address.rsplit(':', 1)
@@ -405,27 +1476,454 @@ def parse_address(address):
         return 'socket', address, None
 
 
+def format_result(result):
+    if type(result) is bytes:
+        return result.decode() + '\n'
+    elif type(result) is list:
+        return str(list(map(lambda x: x.decode() if type(x) is bytes else x, result))) + '\n'
+    elif type(result) is dict:
+        return str({ (k.decode() if type(k) is bytes else k): v for (k,v) in result.items() }) + '\n'
+    else:
+        result = str(result)
+        if not result.endswith(os.linesep):
+            result += os.linesep
+        return result
+
+
+def decode_result(result):
+    if type(result) is bytes:
+        return result.decode(errors='replace')
+    elif type(result) is list:
+        return [decode_result(x) for x in result]
+    elif type(result) is dict:
+        return {decode_result(k): decode_result(v) for (k, v) in result.items()}
+    return result
+
+
+def format_item(item, output):
+    import json
+    item = decode_result(item)
+    if output == 'raw' and type(item) is str:
+        return item
+    return json.dumps(item, default=str)
+
+
+def print_pages(pages, output):
+    """
+    Print a list result, which arrives as an iterable of lists, item by item.
+    For json, that's a single array. Otherwise, every item goes on its own
+    line.
+    """
+    first = True
+    try:
+        if output == 'json':
+            sys.stdout.write('[')
+        for page in pages:
+            for item in page:
+                if output == 'json':
+                    sys.stdout.write(('' if first else ', ') + format_item(item, output))
+                else:
+                    sys.stdout.write(format_item(item, output) + '\n')
+                first = False
+        if output == 'json':
+            sys.stdout.write(']\n')
+        sys.stdout.flush()
+    except BrokenPipeError:
+        # Stop fetching pages, so that nvim drops the result.
+        if hasattr(pages, 'close'):
+            pages.close()
+        # Python would complain about the broken pipe once more when
+        # flushing stdout at exit.
+        devnull = os.open(os.devnull, os.O_WRONLY)
+        os.dup2(devnull, sys.stdout.fileno())
+        sys.exit(1)
+
+
+def broadcasts(options):
+    return options.all or (options.servername and len(options.servername) > 1)
+
+
+def broadcast(addresses, options, arguments):
+    """
+    Send -cc, -l, --remote-send, --remote-expr and -c to several servers
+    concurrently. Results and errors are prefixed by the server address.
+    """
+    import asyncio
+    from nvr.rpc import AsyncClient
+
+    if any(file_lists(options, arguments)) or options.q or options.t or options.d:
+        print('[!] Only -cc, -c, -l, --remote-send and --remote-expr can be sent to several servers.', file=sys.stderr)
+        sys.exit(1)
+
+    cc = [sys.stdin.read() if cmd == '-' else cmd for cmd in options.cc or []]
+    expr = sys.stdin.read() if options.remote_expr == '-' else options.remote_expr
+    c = [sys.stdin.read() if cmd == '-' else cmd for cmd in options.c or []]
+    timeout = options.timeout or 5
+
+    async def run(address):
+        client = await AsyncClient.connect(address)
+        try:
+            for cmd in cc:
+                await client.request('nvim_command', cmd)
+            if options.l:
+                await client.request('nvim_command', 'wincmd p')
+            if options.remote_send:
+                await client.request('nvim_input', options.remote_send)
+            result = None
+            if expr:
+                result = await client.request('nvim_eval', expr)
+            for cmd in c:
+                await client.request('nvim_command', cmd)
+            return result
+        finally:
+            await client.close()
+
+    async def run_all():
+        return await asyncio.gather(
+                *(asyncio.wait_for(run(address), timeout) for address in addresses),
+                return_exceptions=True)
+
+    exitcode = 0
+    for address, result in zip(addresses, asyncio.run(run_all())):
+        if isinstance(result, asyncio.TimeoutError):
+            print(f'{address}: [!] No response within {timeout}s.', file=sys.stderr)
+            exitcode = 1
+        elif isinstance(result, Exception):
+            print(f'{address}: [!] {result}', file=sys.stderr)
+            exitcode = 1
+        elif expr:
+            print(f'{address}: {format_result(result)}', end='', flush=True)
+    if exitcode:
+        sys.exit(exitcode)
+
+
+def run_pool(size, options, arguments):
+    """
+    Start headless nvim processes and let them edit files in parallel. Each
+    process runs -cc once. Then it takes one file after another, runs -c on
+    it and writes it, until all files are done.
+    """
+    import asyncio
+    import shutil
+    import subprocess
+    import tempfile
+    from nvr.rpc import AsyncClient
+
+    cmds, files = split_cmds_from_files(list(arguments))
+    before = options.cc or []
+    after = (options.c or []) + cmds
+    if '-' in files + before + after:
+        print('[!] --pool can\'t read from stdin.', file=sys.stderr)
+        sys.exit(1)
+    if not files:
+        print('[!] --pool needs files to edit.', file=sys.stderr)
+        sys.exit(1)
+    files = [os.path.abspath(f) for f in files]
+
+    args = nvim_cmd()
+    timeout = start_timeout()
+    request_timeout = options.timeout or 5
+    tmpdir = tempfile.mkdtemp(prefix='nvr-pool-')
+    addresses = [os.path.join(tmpdir, f'{i}.sock') for i in range(min(size, len(files)))]
+    processes = []
+    errors = []
+    hung = set()
+    taken = 0
+    finished = False
+
+    async def connect(address):
+        # Like Nvr.wait_for_server, but without blocking the other workers.
+        delays = backoff(timeout)
+        while True:
+            try:
+                return await AsyncClient.connect(address)
+            except OSError:
+                delay = next(delays, None)
+                if delay is None:
+                    raise
+                await asyncio.sleep(delay)
+
+    async def request(client, method, *args):
+        # A worker that hangs, e.g. at a prompt, must not hang the pool.
+        return await asyncio.wait_for(client.request(method, *args), request_timeout)
+
+    async def work(address, paths):
+        nonlocal taken
+        try:
+            client = await connect(address)
+        except OSError as e:
+            errors.append((address, f'Worker did not start: {e}'))
+            return
+        try:
+            for cmd in before:
+                await request(client, 'nvim_command', cmd)
+            # All workers take files from the same iterator, so a worker that
+            # is done early takes more files.
+            for path in paths:
+                taken += 1
+                try:
+                    error = await request(client, 'nvim_exec_lua', LUA_POOL_EDIT, [path, after])
+                except asyncio.TimeoutError:
+                    errors.append((path, f'No response within {request_timeout}s.'))
+                    hung.add(address)
+                    return
+                except EOFError as e:
+                    errors.append((path, str(e)))
+                    return
+                if error:
+                    errors.append((path, error))
+        except asyncio.TimeoutError:
+            errors.append((address, f'No response within {request_timeout}s.'))
+            hung.add(address)
+        except Exception as e:
+            errors.append((address, str(e)))
+        finally:
+            client.notify('nvim_command', 'qall!')
+            await client.close()
+
+    async def work_all():
+        paths = iter(files)
+        await asyncio.gather(*(work(address, paths) for address in addresses))
+
+    try:
+        for address in addresses:
+            processes.append(subprocess.Popen(
+                    args + ['-n', '--headless', '--cmd', 'set shortmess+=A', '--listen', address],
+                    stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL))
+        asyncio.run(work_all())
+        finished = True
+    except FileNotFoundError:
+        print(f'[!] Can\'t start new nvim process: `{args[0]}` is not in $PATH.', file=sys.stderr)
+        sys.exit(1)
+    finally:
+        for address, process in zip(addresses, processes):
+            # A hung worker won't quit on its own.
+            if not finished or address in hung:
+                process.terminate()
+            try:
+                process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+                process.wait()
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+    for name, error in errors:
+        print(f'[!] {name}: {error}', file=sys.stderr)
+    if taken < len(files):
+        print(f'[!] {len(files) - taken} of {len(files)} files were skipped.', file=sys.stderr)
+    if errors or taken < len(files):
+        sys.exit(1)
+
+
+def resolve_address(options, env):
+    return (options.servername and options.servername[0]) or default_address(env)
+
+
+def default_address(env):
+    address = env.get('NVIM') or env.get('NVIM_LISTEN_ADDRESS')
+    if not address:
+        # Since before build 17063 windows doesn't support unix socket, we need another way
+        address = '127.0.0.1:6789' if os.name == 'nt' else '/tmp/nvimsocket'
+    return address
+
+
+def file_lists(options, arguments):
+    return [arguments, options.o, options.O, options.p,
+            options.remote, options.remote_wait, options.remote_silent,
+            options.remote_wait_silent, options.remote_tab, options.remote_tab_wait,
+            options.remote_tab_silent, options.remote_tab_wait_silent,
+            options.remote_add]
+
+
+def files_to_open(options, arguments):
+    paths = []
+    for files in file_lists(options, arguments):
+        for fname in files or []:
+            if fname in ('-', '--') or fname.startswith('+') or is_netrw_protocol(fname):
+                continue
+            paths.append(os.path.abspath(fname))
+    return paths
+
+
+def reads_stdin(options, arguments):
+    files = file_lists(options, arguments) + [options.cc, options.c]
+    return (any('-' in f for f in files if f)
+            or options.q == '-'
+            or options.remote_expr == '-'
+            or options.batch == '-')
+
+
+def waits_for_buffers(options):
+    # Diff mode waits for the buffers as well, unless it started a new process.
+    return (options.d
+            or options.remote_wait is not None
+            or options.remote_wait_silent is not None
+            or options.remote_tab_wait is not None
+            or options.remote_tab_wait_silent is not None)
+
+
+def broker_address(env):
+    return env.get('NVR_BROKER') or os.path.join(
+            env.get('XDG_RUNTIME_DIR') or '/tmp', f'nvr-broker-{os.getuid()}.sock')
+
+
+def forward_to_broker(argv, env):
+    """
+    Let a running `nvr --daemon` handle this call. Returns the exit code or
+    None if there is no broker or it can't handle the call.
+    """
+    if os.name == 'nt':
+        return None
+    import stat
+    path = broker_address(env)
+    try:
+        st = os.lstat(path)
+    except OSError:
+        return None
+    # The request contains the whole environment, so only talk to a socket
+    # of our own. In /tmp, any user could create it before the broker does.
+    if not stat.S_ISSOCK(st.st_mode) or st.st_uid != os.getuid():
+        return None
+
+    import json
+    import socket
+
+    request = {'argv': list(argv), 'env': dict(env), 'cwd': os.getcwd()}
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+        # The broker greets us when it's ready for this call. Until the
+        # request is sent, it's safe to handle the call ourselves instead of
+        # waiting for a stopped or busy broker.
+        try:
+            sock.settimeout(BROKER_CONNECT_TIMEOUT)
+            sock.connect(path)
+            sock.settimeout(float(env.get('NVR_BROKER_TIMEOUT', 10)))
+            f = sock.makefile('rwb')
+            json.loads(f.readline())
+        except (OSError, ValueError):
+            return None
+        # From now on, the broker might have run the call, so running it
+        # again isn't an option.
+        try:
+            with f:
+                f.write(json.dumps(request).encode() + b'\n')
+                f.flush()
+                reply = json.loads(f.readline())
+        except OSError as e:
+            print(f'[!] No reply from the broker at {path}: {e}', file=sys.stderr)
+            return 1
+        except ValueError:
+            print(f'[!] The broker at {path} closed the connection without replying.', file=sys.stderr)
+            return 1
+
+    if reply['fallback']:
+        return None
+    print(reply['stdout'], end='', flush=True)
+    print(reply['stderr'], end='', file=sys.stderr, flush=True)
+    return reply['exitcode']
+
+
 def main(argv=sys.argv, env=os.environ):
+    # Shell completion is handled before anything else, since it has to be
+    # fast.
+    if argv[1:2] == ['--complete']:
+        from nvr.complete import complete
+        complete(argv[2:], env)
+        return
+
+    # Traced and recorded calls are never forwarded, since the broker would
+    # hide what's going on.
+    if ('--daemon' not in argv
+            and not any(a == '--trace' or a.startswith('--trace=') for a in argv)
+            and not env.get('NVR_TRACE')
+            and not env.get('NVR_STATS')):
+        exitcode = forward_to_broker(argv, env)
+        if exitcode is not None:
+            if exitcode:
+                sys.exit(exitcode)
+            return
+
+    started, cpu = time.perf_counter(), time.process_time()
     options, arguments = parse_args(argv)
 
+    tracer = Tracer(options.trace or env.get('NVR_TRACE'))
+    if tracer.file:
+        # The CPU time so far is spent on starting Python and importing nvr.
+        tracer.emit(type='phase', name='import', ms=round(cpu * 1000, 3))
+        tracer.current = ('parse', started)
+
     if options.version:
         print_versions()
         return
 
+    if options.complete:
+        from nvr.complete import complete
+        complete(options.complete, env)
+        return
+
+    if options.stats:
+        from nvr import stats
+        stats.print_stats(stats.stats_path(env), options.stats, options.output)
+        return
+
     if options.serverlist:
-        print_addresses()
+        print_addresses(env)
         return
 
-    address = options.servername or env.get('NVIM') or env.get('NVIM_LISTEN_ADDRESS')
-    if not address:
-        # Since before build 17063 windows doesn't support unix socket, we need another way
-        address = '127.0.0.1:6789' if os.name == 'nt' else '/tmp/nvimsocket'
+    if options.daemon:
+        from nvr.broker import Broker
+        Broker(broker_address(env), options.s).serve()
+        return
+
+    if options.pool:
+        run_pool(options.pool, options, arguments)
+        return
+
+    if options.ping is not None:
+        addresses = options.ping or all_addresses()
+        if not addresses:
+            print('[!] No nvim process found.', file=sys.stderr)
+            sys.exit(1)
+        ping(addresses, options)
+        return
+
+    if broadcasts(options):
+        addresses = all_addresses() if options.all else options.servername
+        broadcast(addresses, options, arguments)
+        return
+
+    address = None
+    if options.target == 'auto' and not options.servername:
+        from nvr import registry
+        address = registry.select(files_to_open(options, arguments) or [os.getcwd()], env)
+    address = address or resolve_address(options, env)
 
     nvr = Nvr(address, options.s)
+    nvr.tracer = tracer
+    nvr.use_pynvim = waits_for_buffers(options)
+    nvr.connect_timeout = options.connect_timeout
+    if options.timeout:
+        nvr.response_timeout = options.timeout
+    tracer.phase('attach')
     nvr.attach()
+    attached = time.perf_counter()
 
     if not nvr.server:
-        if os.path.exists(nvr.address):
+        reclaimed = False
+        if isinstance(nvr.error, TimeoutError):
+            print(f'[!] {nvr.error}', file=sys.stderr)
+            sys.exit(1)
+        if nvr.is_stale():
+            if not options.reclaim:
+                print(textwrap.dedent(f'''
+                        [!] Nobody listens on {nvr.address} anymore.
+
+                            Did nvim crash? Use --reclaim to remove the socket and start a
+                            new nvim process, or choose another address with --servername.
+                        '''), file=sys.stderr)
+                sys.exit(1)
+            os.remove(nvr.address)
+            reclaimed = True
+        elif os.path.exists(nvr.address):
             print(textwrap.dedent(f'''
                     [!] A file {nvr.address} exists, but we failed to attach to it.
 
@@ -435,27 +1933,69 @@ def main(argv=sys.argv, env=os.environ):
             return
 
         silent = options.remote_silent or options.remote_wait_silent or options.remote_tab_silent or options.remote_tab_wait_silent or options.s
-        if not silent:
+        if not silent and not reclaimed:
             show_message(address)
         if options.nostart:
             sys.exit(1)
         nvr.execute_new_nvim_process(silent, nvr, options, arguments)
 
-    proceed_after_attach(nvr, options, arguments)
+    try:
+        if env.get('NVR_STATS'):
+            proceed_and_record(nvr, options, arguments, env, started, attached)
+        else:
+            proceed_after_attach(nvr, options, arguments)
+    except TimeoutError as e:
+        # The built-in client only has a deadline for the first response.
+        print(f'[!] {e} Is nvim busy? Use --timeout to wait longer.', file=sys.stderr)
+        sys.exit(1)
+    nvr.server.close()
+    tracer.finish()
+
+
+def proceed_and_record(nvr, options, arguments, env, started, attached):
+    from nvr import stats
+    # Both have to be known before proceed_after_attach consumes arguments.
+    operation = stats.operation(options, arguments)
+    files = len(files_to_open(options, arguments))
+    exitcode = 1
+    try:
+        proceed_after_attach(nvr, options, arguments)
+        exitcode = 0
+    except SystemExit as e:
+        exitcode = e.code if type(e.code) is int else int(e.code is not None)
+        raise
+    finally:
+        stats.record_call(env, operation, files, nvr.address, started, attached, nvr.ready, exitcode)
 
 
 def proceed_after_attach(nvr, options, arguments):
+    if options.batch:
+        if acts_on_server(options, arguments):
+            print('[!] --batch can\'t be combined with options that act on the server. Put them in the batch.', file=sys.stderr)
+            sys.exit(1)
+        run_batch(nvr, options.batch)
+        return
+
+    nvr.tracer.phase('execute')
+
     if options.d:
         nvr.diffmode = True
 
+    nvr.chunksize = options.chunk_size
+    if options.pipeline:
+        nvr.pending = []
+    nvr.follow = options.follow
+    nvr.max_lines = options.max_lines
+    nvr.large_size = 0 if options.large else int(options.large_size * 1024 * 1024)
+
     if options.cc:
         for cmd in options.cc:
             if cmd == '-':
                 cmd = sys.stdin.read()
-            nvr.server.command(cmd)
+            nvr.command(cmd)
 
     if options.l:
-        nvr.server.command('wincmd p')
+        nvr.command('wincmd p')
 
     if options.remote is not None:
         nvr.execute(options.remote + arguments, 'edit')
@@ -473,37 +2013,46 @@ def proceed_after_attach(nvr, options, arguments):
         nvr.execute(options.remote_tab_silent + arguments, 'tabedit', silent=True)
     elif options.remote_tab_wait_silent is not None:
         nvr.execute(options.remote_tab_wait_silent + arguments, 'tabedit', silent=True, wait=True)
+    elif options.remote_add is not None:
+        nvr.add_files(options.remote_add + arguments)
     elif arguments and options.d:
         # Emulate `vim -d`.
         options.O = arguments
         arguments = []
 
     if options.remote_send:
-        nvr.server.input(options.remote_send)
+        nvr.input(options.remote_send)
 
     if options.remote_expr:
         result = ''
+        pages = None
         if options.remote_expr == '-':
             options.remote_expr = sys.stdin.read()
+        if options.paged and not options.output:
+            options.output = 'ndjson'
+        nvr.flush()
         try:
-            result = nvr.server.eval(options.remote_expr)
-        except:
+            if options.paged:
+                pages, result = nvr.eval_paged(options.remote_expr)
+            else:
+                result = nvr.server.eval(options.remote_expr)
+        except nvr.server.error:
             print(textwrap.dedent(f"""
                 No valid expression: {options.remote_expr}
                 Test it in Neovim: :echo eval('...')
                 If you want to execute a command, use -c or -cc instead.
             """))
-        if type(result) is bytes:
-            print(result.decode())
+        if pages is not None:
+            print_pages(pages, options.output)
+        elif not options.output:
+            print(format_result(result), end='', flush=True)
         elif type(result) is list:
-            print(list(map(lambda x: x.decode() if type(x) is bytes else x, result)))
-        elif type(result) is dict:
-            print({ (k.decode() if type(k) is bytes else k): v for (k,v) in result.items() })
+            print_pages([result], options.output)
         else:
-            result = str(result)
-            if not result.endswith(os.linesep):
-                result += os.linesep
-            print(result, end='', flush=True)
+            print(format_item(result, options.output), flush=True)
+
+    if options.remote_read:
+        nvr.read_buffer(options.remote_read)
 
     if options.o:
         args = options.o + arguments
@@ -512,7 +2061,7 @@ def proceed_after_attach(nvr, options, arguments):
             nvr.execute(args[1:], 'split', silent=True, wait=False)
         else:
             nvr.execute(args, 'split', silent=True, wait=False)
-        nvr.server.command('wincmd =')
+        nvr.command('wincmd =')
     elif options.O:
         args = options.O + arguments
         if nvr.diffmode and not nvr.started_new_process:
@@ -520,7 +2069,7 @@ def proceed_after_attach(nvr, options, arguments):
             nvr.execute(args[1:], 'vsplit', silent=True, wait=False)
         else:
             nvr.execute(args, 'vsplit', silent=True, wait=False)
-        nvr.server.command('wincmd =')
+        nvr.command('wincmd =')
     elif options.p:
         nvr.execute(options.p + arguments, 'tabedit', silent=True, wait=False)
     else:
@@ -528,6 +2077,7 @@ def proceed_after_attach(nvr, options, arguments):
         nvr.execute(arguments, 'edit', silent=True)
 
     if options.t:
+        nvr.flush()
         try:
             nvr.server.command('tag ' + options.t)
         except nvr.server.error as e:
@@ -535,29 +2085,26 @@ def proceed_after_attach(nvr, options, arguments):
             sys.exit(1)
 
     if options.q:
-        path = nvr.server.funcs.fnameescape(os.environ['PWD'])
-        nvr.server.command('lcd ' + path)
-        nvr.server.funcs.setqflist([])
+        nvr.tracer.phase('quickfix')
         if options.q == '-':
-            for line in sys.stdin:
-                nvr.server.command("caddexpr '{}'".
-                        format(line.rstrip().replace("'", "''").replace('|', r'\|')))
+            nvr.load_quickfix(sys.stdin.buffer)
         else:
-            with open(options.q, 'r') as f:
-                for line in f.readlines():
-                    nvr.server.command("caddexpr '{}'".
-                            format(line.rstrip().replace("'", "''").replace('|', r'\|')))
-        nvr.server.command('silent lcd -')
-        nvr.server.command('cfirst')
+            with open(options.q, 'rb') as f:
+                nvr.load_quickfix(f)
 
     if options.c:
+        nvr.tracer.phase('execute')
         for cmd in options.c:
             if cmd == '-':
                 cmd = sys.stdin.read()
-            nvr.server.command(cmd)
+            nvr.command(cmd)
+
+    nvr.flush()
 
     wait_for_n_buffers = nvr.wait
     if wait_for_n_buffers > 0:
+        nvr.ready = time.perf_counter()
+        nvr.tracer.phase('wait')
         exitcode = 0
 
         def notification_cb(msg, args):
@@ -581,9 +2128,176 @@ def proceed_after_attach(nvr, options, arguments):
 
         nvr.server.run_loop(None, notification_cb, None, err_cb)
         nvr.server.close()
+        nvr.tracer.finish()
         sys.exit(exitcode)
 
-    nvr.server.close()
+
+
+def acts_on_server(options, arguments):
+    return (arguments
+            or any(files is not None for files in file_lists(options, arguments)[1:])
+            or options.cc
+            or options.c
+            or options.l
+            or options.d
+            or options.remote_send is not None
+            or options.remote_expr is not None
+            or options.remote_read
+            or options.q
+            or options.t)
+
+
+def batch_calls(options, arguments):
+    """
+    Return the API calls for a command line that only uses -cc, -l,
+    --remote-send and -c, or None if it does anything else. These calls
+    return nothing, so several of them can be sent in one request.
+    """
+    if (any(file_lists(options, arguments))
+            or options.remote_expr
+            or options.remote_read
+            or options.q
+            or options.t
+            or options.d):
+        return None
+    if '-' in (options.cc or []) + (options.c or []):
+        return None
+    calls = [['nvim_command', [cmd]] for cmd in options.cc or []]
+    if options.l:
+        calls.append(['nvim_command', ['wincmd p']])
+    if options.remote_send:
+        calls.append(['nvim_input', [options.remote_send]])
+    calls += [['nvim_command', [cmd]] for cmd in options.c or []]
+    return calls
+
+
+def batch_error(options, arguments, path):
+    if (options.batch
+            or options.daemon
+            or options.serverlist
+            or options.version
+            or options.servername
+            or options.all
+            or options.pool
+            or options.ping is not None
+            or options.stats
+            or options.complete
+            or options.target != 'default'
+            or options.trace
+            or options.pipeline):
+        return 'Only options that act on the current server work in a batch.'
+    if waits_for_buffers(options):
+        return 'Waiting for buffers doesn\'t work in a batch.'
+    if path == '-' and reads_stdin(options, arguments):
+        return 'Can\'t read from stdin, since the batch is read from there.'
+    return None
+
+
+def run_batch(nvr, path):
+    """
+    Run one nvr command line per line of a file over the connection of nvr.
+    Empty lines and comments are skipped. Consecutive lines that only send
+    commands and keys are queued and sent in one nvim_call_atomic request.
+    Every other line gets a status on stderr, in order.
+    """
+    import contextlib
+    import io
+    import shlex
+
+    name = 'stdin' if path == '-' else path
+    failed = False
+    pending = []
+
+    def report(lineno, message):
+        nonlocal failed
+        failed = True
+        print(f'[!] {name}:{lineno}: {message}', file=sys.stderr)
+
+    def succeed(linenos):
+        for lineno in linenos:
+            print(f'[*] {name}:{lineno}: ok', file=sys.stderr)
+
+    def flush():
+        linenos = [lineno for lineno, _ in pending]
+        calls = [call for _, line_calls in pending for call in line_calls]
+        owners = [lineno for lineno, line_calls in pending for _ in line_calls]
+        pending.clear()
+        while linenos:
+            error = nvr.server.request('nvim_call_atomic', calls)[1] if calls else None
+            if error is None:
+                succeed(linenos)
+                break
+            # nvim stops at the first failing call. The lines before it
+            # succeeded. Skip the rest of its line and send the following
+            # lines again.
+            index, _, message = error
+            failing = linenos.index(owners[index])
+            succeed(linenos[:failing])
+            report(owners[index], message)
+            linenos = linenos[failing + 1:]
+            rest = index + 1
+            while rest < len(owners) and owners[rest] == owners[index]:
+                rest += 1
+            calls, owners = calls[rest:], owners[rest:]
+
+    try:
+        f = sys.stdin if path == '-' else open(path)
+    except OSError as e:
+        print(f'[!] Can\'t read batch: {e}', file=sys.stderr)
+        sys.exit(1)
+
+    try:
+        for lineno, line in enumerate(f, 1):
+            try:
+                words = shlex.split(line, comments=True)
+            except ValueError as e:
+                flush()
+                report(lineno, e)
+                continue
+            if not words:
+                continue
+
+            stderr = io.StringIO()
+            try:
+                with contextlib.redirect_stderr(stderr):
+                    options, arguments = parse_args(['nvr'] + words)
+            except SystemExit:
+                flush()
+                report(lineno, (stderr.getvalue().strip().splitlines() or ['Invalid arguments.'])[-1])
+                continue
+
+            error = batch_error(options, arguments, path)
+            if error:
+                flush()
+                report(lineno, error)
+                continue
+
+            calls = batch_calls(options, arguments)
+            if calls is not None:
+                pending.append((lineno, calls))
+                continue
+
+            flush()
+            line_nvr = Nvr(nvr.address, options.s)
+            line_nvr.server = nvr.server
+            line_nvr.tracer = nvr.tracer
+            try:
+                proceed_after_attach(line_nvr, options, arguments)
+                succeed([lineno])
+            except SystemExit as e:
+                if e.code:
+                    report(lineno, e.code if type(e.code) is str else 'Failed.')
+                else:
+                    succeed([lineno])
+            except Exception as e:
+                report(lineno, e)
+        flush()
+    finally:
+        if f is not sys.stdin:
+            f.close()
+
+    if failed:
+        sys.exit(1)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,177 @@
+"""
+An on-disk registry of nvim processes, so that nvr doesn't have to scan all
+processes every time it wants to know which servers exist.
+
+Every entry maps an address to the pid of its nvim process, its working
+directory and the time nvr last saw it. Entries of processes that are gone
+are pruned whenever the registry is loaded. The registry is only updated by
+scans, i.e. --serverlist, --target auto and shell completion, so that
+ordinary calls never pay for it.
+"""
+
+import json
+import os
+import sys
+import time
+
+from nvr import nvr as core
+
+# Rescan all processes for --target auto, if the last scan is older than that.
+RESCAN_AFTER = 60
+
+
+def cache_dir(env=os.environ):
+    base = env.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'nvr')
+
+
+def registry_path(env=os.environ):
+    return os.path.join(cache_dir(env), 'servers.json')
+
+
+def is_alive(address, entry):
+    pid = entry.get('pid')
+    if pid:
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            # The process exists, but belongs to another user.
+            pass
+    socktype, path, _ = core.parse_address(address)
+    if socktype == 'socket' and not os.path.exists(path):
+        return False
+    return True
+
+
+def scan_path(env=os.environ):
+    return os.path.join(cache_dir(env), 'scanned')
+
+
+def load_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_json(path, data):
+    tmp = f'{path}.{os.getpid()}'
+    try:
+        os.makedirs(os.path.dirname(path), mode=0o700, exist_ok=True)
+        with open(tmp, 'w') as f:
+            json.dump(data, f)
+        os.replace(tmp, path)
+    except OSError:
+        # Everything in the cache directory is only a cache.
+        pass
+
+
+def load(env=os.environ):
+    servers = load_json(registry_path(env)) or {}
+    return {address: entry for address, entry in servers.items() if is_alive(address, entry)}
+
+
+def save(servers, env=os.environ):
+    save_json(registry_path(env), servers)
+
+
+def scanned_at(env=os.environ):
+    """
+    Return when all processes were scanned last, or None.
+    """
+    try:
+        return os.stat(scan_path(env)).st_mtime
+    except OSError:
+        return None
+
+
+def update_from_scan(found, env=os.environ):
+    """
+    Replace the registry with a list of (pid, address) tuples found by
+    scanning all processes. The working directory of every process is
+    recorded as well, in case it can't be looked up later.
+    """
+    now = time.time()
+    servers = {}
+    for pid, address in found:
+        servers[address] = {'pid': pid, 'cwd': current_cwd({'pid': pid}), 'last_seen': now}
+    save(servers, env)
+    try:
+        with open(scan_path(env), 'w'):
+            pass
+    except OSError:
+        pass
+    return servers
+
+
+def current_cwd(entry):
+    # The working directory of the nvim process follows :cd, :tcd and :lcd,
+    # so that's fresher than the one recorded. Asking the process instead of
+    # nvim works even if nvim is busy.
+    pid = entry.get('pid')
+    if pid and sys.platform.startswith('linux'):
+        try:
+            return os.readlink(f'/proc/{pid}/cwd')
+        except OSError:
+            pass
+    elif pid:
+        import psutil
+        try:
+            return psutil.Process(pid).cwd()
+        except psutil.Error:
+            pass
+    return entry.get('cwd')
+
+
+def git_root(path):
+    while True:
+        if os.path.exists(os.path.join(path, '.git')):
+            return path
+        parent = os.path.dirname(path)
+        if parent == path:
+            return None
+        path = parent
+
+
+def contains(root, path):
+    try:
+        return os.path.commonpath([root, path]) == root
+    except ValueError:
+        return False
+
+
+def select(paths, env=os.environ):
+    """
+    Return the address of the server whose working directory or git root
+    contains most of the given absolute paths, or None. On a tie, the server
+    with the most specific directory wins.
+    """
+    servers = load(env)
+    scanned = scanned_at(env)
+    if not servers or scanned is None or time.time() - scanned > RESCAN_AFTER:
+        found, _ = core.find_addresses()
+        servers = update_from_scan(found, env)
+
+    best, best_score = None, None
+    for address, entry in servers.items():
+        cwd = current_cwd(entry)
+        if not cwd:
+            continue
+        roots = [cwd]
+        root = git_root(cwd)
+        if root and root != cwd:
+            roots.append(root)
+        matched = 0
+        specificity = 0
+        for path in paths:
+            lengths = [len(r) for r in roots if contains(r, path)]
+            if lengths:
+                matched += 1
+                specificity = max(specificity, *lengths)
+        score = (matched, specificity, entry.get('last_seen', 0))
+        if matched and (best_score is None or score > best_score):
+            best, best_score = address, score
+    return best
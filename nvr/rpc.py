@@ -0,0 +1,199 @@
+"""
+Minimal msgpack-rpc clients for talking to nvim without pynvim.
+
+They only support what nvr needs: sending requests and notifications, and
+receiving the responses. Notifications sent by nvim are ignored.
+
+Client is synchronous and used for calls that don't wait for buffers, since
+it's much cheaper to import and set up than pynvim. AsyncClient talks to
+several servers concurrently.
+"""
+
+import socket
+
+import msgpack
+
+from nvr.nvr import parse_address
+
+REQUEST = 0
+RESPONSE = 1
+NOTIFICATION = 2
+
+
+class NvimError(Exception):
+    pass
+
+
+def error_message(error):
+    # nvim sends errors as [type, message].
+    if type(error) is list and len(error) == 2:
+        error = error[1]
+    if type(error) is bytes:
+        error = error.decode(errors='replace')
+    return str(error)
+
+
+def new_unpacker():
+    return msgpack.Unpacker(raw=False, unicode_errors='surrogateescape')
+
+
+class Client():
+    """
+    A synchronous client that offers the subset of pynvim's Nvim that nvr
+    uses. Every method sends a request via request() and blocks until the
+    response arrived.
+
+    Only the first response has a deadline: a server that answers it is
+    alive, and later requests may take long, e.g. when opening huge files.
+    """
+    error = NvimError
+
+    def __init__(self, sock, address):
+        self.sock = sock
+        self.address = address
+        self.unpacker = new_unpacker()
+        self.msgid = 0
+        self.answered = False
+        self._channel_id = None
+
+    @classmethod
+    def connect(cls, address, timeout=None, response_timeout=None):
+        """
+        Raise TimeoutError if connecting takes longer than timeout, e.g. for
+        an unreachable host, and ConnectionRefusedError if nobody listens.
+        """
+        socktype, host, port = parse_address(address)
+        try:
+            if socktype == 'tcp':
+                sock = socket.create_connection((host, int(port)), timeout)
+            else:
+                sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                try:
+                    sock.settimeout(timeout)
+                    sock.connect(host)
+                except OSError:
+                    sock.close()
+                    raise
+        except socket.timeout:
+            raise TimeoutError(f'Could not connect to {address} within {timeout}s.') from None
+        sock.settimeout(response_timeout)
+        return cls(sock, address)
+
+    def request(self, method, *args):
+        self.msgid += 1
+        msgid = self.msgid
+        self.sock.sendall(msgpack.packb([REQUEST, msgid, method, list(args)]))
+        while True:
+            for msg in self.unpacker:
+                if msg[0] == RESPONSE and msg[1] == msgid:
+                    if not self.answered:
+                        self.answered = True
+                        self.sock.settimeout(None)
+                    _, _, error, result = msg
+                    if error is not None:
+                        raise NvimError(error_message(error))
+                    return result
+                if msg[0] == REQUEST:
+                    # nvim blocks until it gets a response.
+                    self.sock.sendall(msgpack.packb([RESPONSE, msg[1], 'Not supported by nvr', None]))
+            try:
+                data = self.sock.recv(65536)
+            except socket.timeout:
+                raise TimeoutError(f'No response from {self.address} within {self.sock.gettimeout()}s.') from None
+            if not data:
+                raise EOFError('Connection closed by nvim')
+            self.unpacker.feed(data)
+
+    def expect_response(self, timeout):
+        """
+        Put a deadline on the next response again, e.g. for a connection that
+        is reused for another call.
+        """
+        self.answered = False
+        self.sock.settimeout(timeout)
+
+    @property
+    def channel_id(self):
+        if self._channel_id is None:
+            self._channel_id, _ = self.request('nvim_get_api_info')
+        return self._channel_id
+
+    def command(self, cmd):
+        return self.request('nvim_command', cmd)
+
+    def input(self, keys):
+        return self.request('nvim_input', keys)
+
+    def eval(self, expr):
+        return self.request('nvim_eval', expr)
+
+    def exec_lua(self, code, *args):
+        return self.request('nvim_exec_lua', code, list(args))
+
+    def close(self):
+        self.sock.close()
+
+
+class AsyncClient():
+    def __init__(self, address, reader, writer):
+        self.address = address
+        self.reader = reader
+        self.writer = writer
+        import asyncio
+        self.msgid = 0
+        self.pending = {}
+        self.receiver = asyncio.ensure_future(self.receive())
+
+    @classmethod
+    async def connect(cls, address):
+        import asyncio
+        socktype, host, port = parse_address(address)
+        if socktype == 'tcp':
+            reader, writer = await asyncio.open_connection(host, int(port))
+        else:
+            reader, writer = await asyncio.open_unix_connection(host)
+        return cls(address, reader, writer)
+
+    async def receive(self):
+        unpacker = new_unpacker()
+        try:
+            while True:
+                data = await self.reader.read(65536)
+                if not data:
+                    break
+                unpacker.feed(data)
+                for msg in unpacker:
+                    if msg[0] == RESPONSE:
+                        _, msgid, error, result = msg
+                        future = self.pending.pop(msgid, None)
+                        if future and not future.done():
+                            if error is not None:
+                                future.set_exception(NvimError(error_message(error)))
+                            else:
+                                future.set_result(result)
+        finally:
+            for future in self.pending.values():
+                if not future.done():
+                    future.set_exception(EOFError(f'Connection to {self.address} closed'))
+            self.pending.clear()
+
+    async def request(self, method, *args):
+        import asyncio
+        self.msgid += 1
+        future = asyncio.get_event_loop().create_future()
+        self.pending[self.msgid] = future
+        self.writer.write(msgpack.packb([REQUEST, self.msgid, method, list(args)]))
+        await self.writer.drain()
+        return await future
+
+    def notify(self, method, *args):
+        self.writer.write(msgpack.packb([NOTIFICATION, method, list(args)]))
+
+    async def close(self):
+        import asyncio
+        self.receiver.cancel()
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except (OSError, asyncio.CancelledError):
+            pass
@@ -0,0 +1,197 @@
+"""
+Local latency telemetry. If $NVR_STATS is set, every nvr call appends a
+record to a ring buffer file: the kind of operation, the number of files,
+the time it took to attach, until nvim was done and in total, the exit code
+and the server address. `nvr --stats` aggregates the records.
+
+$NVR_STATS is either a path or "1" for $XDG_CACHE_HOME/nvr/stats. The file
+consists of a header and CAPACITY fixed-size records, so it never grows
+beyond about 1 MB. Writers lock it with flock().
+"""
+
+import os
+import re
+import struct
+import sys
+import time
+
+from nvr import nvr as core
+from nvr import registry
+
+MAGIC = b'NVRS'
+CAPACITY = 10000
+
+# magic, capacity, index of the next record, number of records
+HEADER = struct.Struct('<4sIII')
+
+# time, operation, files, attach ms, ready ms, total ms, exit code, address
+RECORD = struct.Struct('<d24sIfffi64s')
+
+# Options that name the operation of a call, in order of precedence.
+OPERATIONS = ['batch', 'pool', 'remote_wait', 'remote_wait_silent', 'remote_tab_wait',
+              'remote_tab_wait_silent', 'remote', 'remote_silent', 'remote_tab',
+              'remote_tab_silent', 'remote_add', 'o', 'O', 'p', 'q', 't', 'remote_read',
+              'remote_expr', 'remote_send', 'cc', 'c']
+
+
+def stats_path(env=os.environ):
+    path = env.get('NVR_STATS')
+    if path == '1':
+        return os.path.join(registry.cache_dir(env), 'stats')
+    return path
+
+
+def operation(options, arguments):
+    for name in OPERATIONS:
+        if getattr(options, name) is not None:
+            return ('-' if len(name) == 1 else '--') + name.replace('_', '-')
+    return 'files' if arguments else 'none'
+
+
+def record(path, *fields):
+    """
+    Write a record to the ring buffer, overwriting the oldest one if it's
+    full. The fields are the ones of RECORD.
+    """
+    try:
+        import fcntl
+    except ImportError:
+        return
+    try:
+        os.makedirs(os.path.dirname(os.path.abspath(path)), mode=0o700, exist_ok=True)
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+    except OSError:
+        return
+    try:
+        fcntl.flock(fd, fcntl.LOCK_EX)
+        header = os.pread(fd, HEADER.size, 0)
+        index, count = 0, 0
+        if len(header) == HEADER.size:
+            magic, capacity, index, count = HEADER.unpack(header)
+            if magic != MAGIC or capacity != CAPACITY:
+                index, count = 0, 0
+        os.pwrite(fd, RECORD.pack(*fields), HEADER.size + index * RECORD.size)
+        os.pwrite(fd, HEADER.pack(MAGIC, CAPACITY, (index + 1) % CAPACITY, min(count + 1, CAPACITY)), 0)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
+
+
+def record_call(env, operation, files, address, started, attached, ready, exitcode):
+    """
+    Record a call that started, attached and was ready at the given
+    time.perf_counter() values. The call is ready before it waits for
+    buffers.
+    """
+    now = time.perf_counter()
+    record(stats_path(env),
+           time.time(),
+           operation.encode()[:24],
+           files,
+           (attached - started) * 1000,
+           ((ready or now) - started) * 1000,
+           (now - started) * 1000,
+           exitcode,
+           address.encode(errors='surrogateescape')[:64])
+
+
+def load(path):
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+    except OSError:
+        return []
+    if len(data) < HEADER.size:
+        return []
+    magic, capacity, _, count = HEADER.unpack_from(data)
+    if magic != MAGIC or capacity != CAPACITY:
+        return []
+    records = []
+    for i in range(min(count, (len(data) - HEADER.size) // RECORD.size)):
+        fields = RECORD.unpack_from(data, HEADER.size + i * RECORD.size)
+        records.append({
+            'time': fields[0],
+            'operation': fields[1].rstrip(b'\0').decode(errors='replace'),
+            'files': fields[2],
+            'attach_ms': fields[3],
+            'ready_ms': fields[4],
+            'total_ms': fields[5],
+            'exitcode': fields[6],
+            'address': fields[7].rstrip(b'\0').decode(errors='replace'),
+        })
+    return sorted(records, key=lambda r: r['time'])
+
+
+def parse_window(window):
+    """
+    Turn e.g. "30m", "12h" or "7d" into seconds. "all" is None.
+    """
+    if window == 'all':
+        return None
+    match = re.fullmatch(r'(\d+)([smhd])', window)
+    if not match:
+        print(f'[!] Invalid time window: {window}. Use e.g. 30m, 12h, 7d or all.', file=sys.stderr)
+        sys.exit(1)
+    return int(match.group(1)) * {'s': 1, 'm': 60, 'h': 3600, 'd': 86400}[match.group(2)]
+
+
+def histogram(samples):
+    """
+    Count the samples per power-of-two bucket in ms. Keys are upper bounds.
+    """
+    buckets = {}
+    for sample in samples:
+        bound = 1
+        while sample > bound:
+            bound *= 2
+        buckets[bound] = buckets.get(bound, 0) + 1
+    return dict(sorted(buckets.items()))
+
+
+def aggregate(records):
+    """
+    Return per-operation statistics of the time until nvim was done. For
+    calls that wait for buffers that excludes the waiting.
+    """
+    operations = {}
+    for r in records:
+        operations.setdefault(r['operation'], []).append(r)
+    result = {}
+    for name, group in sorted(operations.items()):
+        ready = [round(r['ready_ms'], 3) for r in group]
+        result[name] = {
+            'count': len(group),
+            'failed': sum(1 for r in group if r['exitcode']),
+            'attach_p50': round(core.percentile([r['attach_ms'] for r in group], 50), 3),
+            'p50': core.percentile(ready, 50),
+            'p90': core.percentile(ready, 90),
+            'p99': core.percentile(ready, 99),
+            'max': max(ready),
+            'histogram': histogram(ready),
+        }
+    return result
+
+
+def print_stats(path, window, output=None):
+    if not path:
+        print('[!] Set $NVR_STATS to "1" or a path to record stats.', file=sys.stderr)
+        sys.exit(1)
+    seconds = parse_window(window)
+    records = load(path)
+    if seconds is not None:
+        records = [r for r in records if r['time'] >= time.time() - seconds]
+    result = aggregate(records)
+
+    if output in ('json', 'ndjson'):
+        print(core.format_item(result, output))
+        return
+
+    print(f'{"OPERATION":<24} {"COUNT":>6} {"FAILED":>6} {"ATTACH":>8} {"P50":>8} {"P90":>8} {"P99":>8} {"MAX":>8}')
+    for name, s in result.items():
+        print(f'{name:<24} {s["count"]:>6} {s["failed"]:>6} {s["attach_p50"]:8.2f} '
+              f'{s["p50"]:8.2f} {s["p90"]:8.2f} {s["p99"]:8.2f} {s["max"]:8.2f}')
+        most = max(s['histogram'].values())
+        for bound, count in s['histogram'].items():
+            bar = '#' * max(1, round(count / most * 40))
+            print(f'    <= {bound:>6} ms  {bar:<40} {count}')
@@ -1,10 +1,17 @@
 #!/usr/bin/env python3
 
+import io
+import json
 import os
+import sys
 import time
 import subprocess
+import textwrap
 import uuid
+import pytest
 import nvr
+from nvr.nvr import find_addresses_proc, find_addresses_psutil
+from nvr.rpc import NvimError
 
 # Helper functions
 
@@ -67,3 +74,323 @@ def test_escape_double_quotes_in_filenames(capsys):
     nvim.terminate()
     out, err = capsys.readouterr()
     assert filename == out.rstrip()
+
+def test_open_multiple_files_in_one_batch(capsys):
+    env = setup_env()
+    nvim = run_nvim(env)
+    cmdlines = [['nvr', '-s', '--nostart', '-o', 'foo', 'bar', 'quux'],
+                ['nvr', '-s', '--nostart', '--remote-expr', 'winnr("$")']]
+    run_nvr(cmdlines, env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == '4\n'
+
+def test_read_stdin_into_buffer(capsys, monkeypatch):
+    env = setup_env()
+    nvim = run_nvim(env)
+    monkeypatch.setattr('sys.stdin', io.TextIOWrapper(io.BytesIO(b'a\nb\n\nc')))
+    cmdlines = [['nvr', '-s', '--nostart', '--chunk-size', '2', '-'],
+                ['nvr', '-s', '--nostart', '--remote-expr', 'join(getline(1, "$"), ",") . &modified']]
+    run_nvr(cmdlines, env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == 'a,b,,c0\n'
+
+def test_quickfix_from_errorfile(capsys, tmp_path):
+    errorfile = tmp_path / 'errors'
+    errorfile.write_text(''.join(f'foo.c:{i}:1: error {i}\n' for i in range(1, 6)))
+    env = setup_env()
+    nvim = run_nvim(env)
+    cmdlines = [['nvr', '-s', '--nostart', '--chunk-size', '2', '-q', str(errorfile)],
+                ['nvr', '-s', '--nostart', '--remote-expr', 'len(getqflist()) . ":" . line(".")']]
+    run_nvr(cmdlines, env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == '5:1\n'
+
+def test_broker(capsys, tmp_path):
+    env = setup_env()
+    env['NVR_BROKER'] = str(tmp_path / 'broker')
+    nvim = run_nvim(env)
+    broker = subprocess.Popen([sys.executable, '-c', 'import nvr; nvr.main(["nvr", "-s", "--daemon"])'], env=env)
+    time.sleep(1)
+    cmdlines = [['nvr', '--nostart', '--remote-send', 'iabc<cr><esc>'],
+                ['nvr', '--nostart', '--remote-expr', 'getline(1)']]
+    run_nvr(cmdlines, env)
+    broker.terminate()
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == 'abc\n'
+    assert broker.wait() == 0
+
+# Importing nvr must stay cheap: most calls only attach and send a single
+# command. Override the budget via $NVR_IMPORT_BUDGET_US on slow machines.
+def test_import_time_budget():
+    budget = int(os.environ.get('NVR_IMPORT_BUDGET_US', 50000))
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import nvr'],
+                          stderr=subprocess.PIPE, universal_newlines=True, check=True)
+    cumulative = {}
+    for line in proc.stderr.splitlines():
+        _, usecs, name = line.split('|')
+        if usecs.strip().isdigit():
+            cumulative[name.strip()] = int(usecs)
+    for module in ['pynvim', 'psutil', 'multiprocessing', 'argparse', 'pkg_resources']:
+        assert module not in cumulative
+    assert cumulative['nvr'] < budget
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'), reason='requires /proc')
+def test_serverlist_proc_matches_psutil():
+    env = setup_env()
+    nvim = run_nvim(env)
+    servers, errors = find_addresses_proc(jobs=4)
+    expected, expected_errors = find_addresses_psutil()
+    nvim.terminate()
+    assert any(pid == nvim.pid for (pid, _) in servers)
+    assert sorted(servers) == sorted(expected)
+    assert sorted(errors) == sorted(expected_errors)
+
+def test_target_auto(capsys, tmp_path):
+    env = setup_env()
+    env['XDG_CACHE_HOME'] = str(tmp_path / 'cache')
+    nvims = {}
+    for name in ['foo', 'bar']:
+        (tmp_path / name).mkdir()
+        address = str(tmp_path / f'{name}.sock')
+        nvims[name] = subprocess.Popen(['nvim', '-nu', 'NORC', '--headless', '--listen', address],
+                                       cwd=str(tmp_path / name), env=env)
+    time.sleep(1)
+    cmdlines = [['nvr', '-s', '--nostart', '--target', 'auto', str(tmp_path / 'bar' / 'file')],
+                ['nvr', '-s', '--nostart', '--servername', str(tmp_path / 'bar.sock'),
+                 '--remote-expr', 'fnamemodify(bufname(""), ":t")']]
+    run_nvr(cmdlines, env)
+    for nvim in nvims.values():
+        nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == 'file\n'
+
+def test_remote_wait_installs_autocmds_once(capsys):
+    env = setup_env()
+    nvim = run_nvim(env)
+    waiting = [subprocess.Popen([sys.executable, '-c', 'import nvr; nvr.main(["nvr", "-s", "--nostart", "--remote-wait", "foo"])'], env=env)
+               for _ in range(3)]
+    time.sleep(1)
+    cmdlines = [['nvr', '-s', '--nostart', '--remote-expr', 'len(nvim_get_autocmds({"group": "nvr_wait", "event": "VimLeave"}))'],
+                ['nvr', '-s', '--nostart', '--remote-expr', 'len(b:nvr)'],
+                ['nvr', '-s', '--nostart', '-c', 'bdelete! foo']]
+    run_nvr(cmdlines, env)
+    exitcodes = [p.wait(timeout=5) for p in waiting]
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == '1\n3\n'
+    assert exitcodes == [0, 0, 0]
+
+def test_broadcast_to_several_servers(capsys):
+    envs = [setup_env() for _ in range(2)]
+    nvims = [run_nvim(env) for env in envs]
+    addresses = [env['NVIM_LISTEN_ADDRESS'] for env in envs]
+    cmdline = ['nvr', '--nostart', '-c', 'let g:foo = 42', '--remote-expr', 'g:foo']
+    for address in addresses:
+        cmdline[1:1] = ['--servername', address]
+    run_nvr([cmdline], envs[0])
+    for nvim in nvims:
+        nvim.terminate()
+    out, err = capsys.readouterr()
+    assert sorted(out.splitlines()) == sorted(f'{address}: 42' for address in addresses)
+
+def test_trace(capsys, tmp_path):
+    env = setup_env()
+    env['NVR_TRACE'] = str(tmp_path / 'trace')
+    nvim = run_nvim(env)
+    run_nvr([['nvr', '-s', '--nostart', '--remote-expr', '"foo"']], env)
+    nvim.terminate()
+    with open(env['NVR_TRACE']) as f:
+        records = [json.loads(line) for line in f]
+    phases = [r['name'] for r in records if r['type'] == 'phase']
+    rpcs = [r for r in records if r['type'] == 'rpc']
+    assert phases[:3] == ['import', 'parse', 'attach']
+    assert {'method': 'nvim_eval', 'args_bytes': 7, 'result_bytes': 4} in [
+            {k: r[k] for k in ['method', 'args_bytes', 'result_bytes']} for r in rpcs]
+
+
+def test_remote_expr_paged(capsys):
+    env = setup_env()
+    nvim = run_nvim(env)
+    run_nvr([['nvr', '-s', '--nostart', '--paged', '--chunk-size', '2', '--remote-expr', 'range(5)'],
+             ['nvr', '-s', '--nostart', '--output', 'raw', '--remote-expr', '["a", "b"]'],
+             ['nvr', '-s', '--nostart', '--output', 'json', '--remote-expr', '{"a": 1}']], env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == '0\n1\n2\n3\n4\na\nb\n{"a": 1}\n'
+
+def test_remote_add(capsys, tmp_path):
+    paths = []
+    for name in ['foo', 'bar', 'quux']:
+        (tmp_path / name).write_text(name)
+        paths.append(str(tmp_path / name))
+    env = setup_env()
+    nvim = run_nvim(env)
+    cmdlines = [['nvr', '-s', '--nostart', '--chunk-size', '2', '--remote-add'] + paths,
+                ['nvr', '-s', '--nostart', '--remote-expr',
+                 'fnamemodify(bufname(""), ":t") . len(getbufinfo({"buflisted": 1})) . bufloaded("bar")']]
+    run_nvr(cmdlines, env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == 'foo30\n'
+
+def test_follow_stdin(capsys, monkeypatch):
+    env = setup_env()
+    nvim = run_nvim(env)
+    r, w = os.pipe()
+    os.write(w, b''.join(b'%d\n' % i for i in range(10)))
+    os.close(w)
+    monkeypatch.setattr('sys.stdin', open(r))
+    cmdlines = [['nvr', '-s', '--nostart', '--follow', '--max-lines', '3', '--chunk-size', '4', '-'],
+                ['nvr', '-s', '--nostart', '--remote-expr', 'join(getline(1, "$"), ",") . line(".") . &modified']]
+    run_nvr(cmdlines, env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == '7,8,930\n'
+
+def test_remote_read(capsys):
+    env = setup_env()
+    nvim = run_nvim(env)
+    cmdlines = [['nvr', '-s', '--nostart', '--remote-send', 'ifoo<cr>bar<cr>quux<esc>'],
+                ['nvr', '-s', '--nostart', '--chunk-size', '2', '--remote-read', '%']]
+    run_nvr(cmdlines, env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == 'foo\nbar\nquux\n'
+
+def test_batch(capsys, tmp_path):
+    batch = tmp_path / 'batch'
+    batch.write_text(textwrap.dedent('''\
+        # Comments and empty lines are skipped.
+        --remote-send 'ifoo<esc>'
+
+        -c 'let g:a = 1' -c nosuchcommand -c 'let g:b = 2'
+        -c 'let g:c = 3'
+        --remote-expr 'getline(1) . exists("g:a") . exists("g:b") . exists("g:c")'
+    '''))
+    env = setup_env()
+    nvim = run_nvim(env)
+    with pytest.raises(SystemExit) as e:
+        run_nvr([['nvr', '-s', '--nostart', '--batch', str(batch)]], env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert e.value.code == 1
+    assert out == 'foo101\n'
+    assert f'[!] {batch}:4:' in err
+    assert [line for line in err.splitlines() if line.endswith(': ok')] == [
+            f'[*] {batch}:{lineno}: ok' for lineno in [2, 5, 6]]
+
+def test_complete_buffers(capsys, tmp_path):
+    env = setup_env()
+    env['XDG_CACHE_HOME'] = str(tmp_path / 'cache')
+    nvim = run_nvim(env)
+    cmdlines = [['nvr', '-s', '--nostart', str(tmp_path / 'foo')],
+                ['nvr', '--complete', 'buffers']]
+    run_nvr(cmdlines, env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == f'{tmp_path / "foo"}\n'
+
+def test_ping(capsys):
+    env = setup_env()
+    nvim = run_nvim(env)
+    run_nvr([['nvr', '--ping', env['NVIM_LISTEN_ADDRESS'], '--count', '3', '--output', 'json']], env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    [report] = json.loads(out)
+    assert report['status'] == 'ok'
+    assert 0 <= report['min'] <= report['p50'] <= report['p99']
+
+def test_pool(tmp_path):
+    paths = []
+    for i in range(10):
+        (tmp_path / f'file{i}').write_text(f'foo {i}\n')
+        paths.append(str(tmp_path / f'file{i}'))
+    run_nvr([['nvr', '--pool', '3', '-cc', 'let g:bar = "bar"', '-c', 's/foo/\\=g:bar/'] + paths], setup_env())
+    assert [open(path).read() for path in paths] == [f'bar {i}\n' for i in range(10)]
+
+def test_stats(capsys, tmp_path):
+    env = setup_env()
+    env['NVR_STATS'] = str(tmp_path / 'stats')
+    nvim = run_nvim(env)
+    cmdlines = [['nvr', '-s', '--nostart', '--remote-expr', '1'],
+                ['nvr', '-s', '--nostart', '--remote-expr', '2'],
+                ['nvr', '-s', '--nostart', '--remote-send', 'ifoo<esc>']]
+    run_nvr(cmdlines, env)
+    nvim.terminate()
+    capsys.readouterr()
+    run_nvr([['nvr', '--stats', '1h', '--output', 'json']], env)
+    out, err = capsys.readouterr()
+    stats = json.loads(out)
+    assert stats['--remote-expr']['count'] == 2
+    assert stats['--remote-send']['count'] == 1
+    assert stats['--remote-expr']['failed'] == 0
+
+def test_pipeline(capsys):
+    env = setup_env()
+    nvim = run_nvim(env)
+    cmdlines = [['nvr', '-s', '--nostart', '--pipeline', '-cc', 'let g:a = 1', '-c', 'let g:b = g:a + 1', 'foo'],
+                ['nvr', '-s', '--nostart', '--remote-expr', 'g:b . fnamemodify(bufname(""), ":t")']]
+    run_nvr(cmdlines, env)
+    with pytest.raises(NvimError, match='nosuchcommand'):
+        run_nvr([['nvr', '-s', '--nostart', '--pipeline', '-cc', 'nosuchcommand', '-c', 'let g:c = 1']], env)
+    run_nvr([['nvr', '-s', '--nostart', '--remote-expr', 'exists("g:c")']], env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == '2foo\n0\n'
+
+# Calls that don't wait for buffers must not import pynvim.
+def test_builtin_client():
+    env = setup_env()
+    nvim = run_nvim(env)
+    code = 'import sys, nvr; nvr.main(sys.argv); print("pynvim" in sys.modules)'
+    proc = subprocess.run([sys.executable, '-c', code, '--nostart', '--remote-expr', '[1, "a"]'],
+                          env=env, stdout=subprocess.PIPE, universal_newlines=True)
+    nvim.terminate()
+    assert proc.stdout == "[1, 'a']\nFalse\n"
+
+def test_stale_socket(capsys, tmp_path):
+    import socket
+    address = str(tmp_path / 'stale.sock')
+    sock = socket.socket(socket.AF_UNIX)
+    sock.bind(address)
+    sock.close()
+    env = setup_env()
+    with pytest.raises(SystemExit) as e:
+        run_nvr([['nvr', '-s', '--nostart', '--servername', address, '--remote-expr', '1']], env)
+    assert e.value.code == 1
+    assert os.path.exists(address)
+    out, err = capsys.readouterr()
+    assert 'Nobody listens on' in err
+    with pytest.raises(SystemExit):
+        run_nvr([['nvr', '-s', '--nostart', '--reclaim', '--servername', address, '--remote-expr', '1']], env)
+    assert not os.path.exists(address)
+
+def test_large_file(capsys, tmp_path):
+    small, large = tmp_path / 'small.txt', tmp_path / 'large.txt'
+    small.write_text('x\n')
+    large.write_text('x' * 2000 + '\n')
+    env = setup_env()
+    nvim = run_nvim(env)
+    expr = '[&l:undolevels, &l:swapfile, &l:syntax]'
+    cmdlines = [['nvr', '-s', '--nostart', '--large-size', '0.001', str(large)],
+                ['nvr', '-s', '--nostart', '--remote-expr', expr],
+                ['nvr', '-s', '--nostart', '--large-size', '0.001', str(small)],
+                ['nvr', '-s', '--nostart', '--remote-expr', '&l:undolevels == -1'],
+                ['nvr', '-s', '--nostart', '--large', str(small)],
+                ['nvr', '-s', '--nostart', '--remote-expr', '&l:undolevels']]
+    run_nvr(cmdlines, env)
+    nvim.terminate()
+    out, err = capsys.readouterr()
+    assert out == "[-1, 0, 'OFF']\n0\n-1\n"
+
+def test_percentile():
+    from nvr.nvr import percentile
+    assert percentile([1, 2], 50) == 1
+    assert percentile(range(1, 7), 50) == 3
+    assert percentile(range(1, 11), 90) == 9
+    assert percentile(range(1, 11), 99) == 10
+    assert percentile([5], 0) == 5